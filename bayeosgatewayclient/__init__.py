@@ -1,3 +1,11 @@
 """bayeosgatewayclient"""
 
-from bayeosgatewayclient import *
\ No newline at end of file
+from bayeosgatewayclient import *
+from bayeosasync import *
+from bayeosgateway import BayEOSGatewayEmulator
+from bayeosmetrics import REGISTRY, Metrics, MetricsRegistry, PrometheusFileSink, PrometheusHTTPServer
+from bayeosframe import FrameRecord, decode_frame
+from bayeosexport import decode_file, decode_files, expand_paths, to_arrays, write_csv
+from bayeosarchive import BackupArchive
+from bayeosschedule import TickScheduler, monotonic
+from bayeoscache import PayloadCache
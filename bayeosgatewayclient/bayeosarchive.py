@@ -0,0 +1,214 @@
+"""Compressed archives of sent queue files.
+
+BackupArchive rolls the .bak files a BayEOSSender keeps with remove=False
+into gzip files, one per time partition. Every run appends gzip members of
+plain queue records (see bayeosqueue). An index with one JSON line per member
+stores its position, time range and origins, so queries only decompress
+the members they need.
+"""
+
+import os
+import json
+import zlib
+import logging
+from glob import glob
+from time import gmtime, strftime
+try:
+    import fcntl
+except ImportError:  # not a POSIX platform, archive runs are not locked
+    fcntl = None
+from bayeosqueue import QueueFileReader, RECORD_HEADER, pack_record, frame_origin, \
+    queue_file_time, queue_file_key
+
+# partition : strftime format of the partition key, in UTC
+PARTITIONS = {'hour' : '%Y%m%d%H',
+              'day' : '%Y%m%d',
+              'month' : '%Y%m'}
+ARCHIVE_NAME = 'archive-%s.gz'
+INDEX_NAME = 'index'
+
+class BackupArchive(object):
+    """Time-partitioned gzip archive of queue records with an index."""
+
+    def __init__(self, path, partition='day', level=6, member_size=4194304):
+        """Creates an archive in a directory.
+        @param path: archive directory
+        @param partition: 'hour', 'day' or 'month'
+        @param level: zlib compression level
+        @param member_size: uncompressed bytes per gzip member, the unit a query decompresses
+        """
+        if partition not in PARTITIONS:
+            logging.warning('Unknown partition ' + str(partition) + '. Using day.')
+            partition = 'day'
+        self.path = os.path.abspath(path)
+        self.partition = partition
+        self.level = level
+        self.member_size = member_size
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0700)
+        self.index_name = os.path.join(self.path, INDEX_NAME)
+
+    def archive(self, queue_path, pattern='*.bak'):
+        """Moves all matching files of a queue directory into the archive.
+        @return number of archived files
+        """
+        return self.add(glob(os.path.join(queue_path, pattern)))
+
+    def add(self, file_names):
+        """Appends queue files to the archives of their partitions and removes them.
+        The partition of a file is given by the time the file was started.
+        Files are only removed after their records and the index entry are written.
+        @param file_names: list of queue files
+        @return number of archived files
+        """
+        partitions = {}
+        for file_name in sorted(file_names, key=queue_file_key):
+            key = strftime(PARTITIONS[self.partition], gmtime(queue_file_time(file_name)))
+            partitions.setdefault(key, []).append(file_name)
+        archived = 0
+        with open(self.index_name, 'a+') as index:
+            if fcntl:
+                fcntl.flock(index, fcntl.LOCK_EX)
+            index.seek(0, os.SEEK_END)
+            if index.tell():
+                index.seek(-1, os.SEEK_END)
+                if index.read(1) != '\n':  # line of an interrupted write
+                    index.write('\n')
+            ends = self.__archive_ends()
+            for key, partition_files in sorted(partitions.items()):
+                archive_name = ARCHIVE_NAME % key
+                ends[archive_name] = self.__add_partition(
+                    index, archive_name, ends.get(archive_name, 0), partition_files)
+                archived += len(partition_files)
+        return archived
+
+    def __archive_ends(self):
+        """@return dictionary archive name : end of its last indexed member"""
+        ends = {}
+        for entry in self.entries():
+            ends[entry['archive']] = max(ends.get(entry['archive'], 0),
+                                         entry['offset'] + entry['length'])
+        return ends
+
+    def __add_partition(self, index, archive_name, end, file_names):
+        """Appends the records of files as gzip members behind end.
+        Bytes behind end are left over from an interrupted run and are cut off.
+        @return new end of the archive
+        """
+        with open(os.path.join(self.path, archive_name), 'ab') as archive:
+            archive.truncate(end)
+            records = []
+            size = 0
+            done = []
+            for file_name in file_names:
+                try:
+                    with QueueFileReader(file_name) as reader:
+                        for timestamp, frame in reader:
+                            records.append(pack_record(timestamp, str(frame)))
+                            size += len(records[-1])
+                except (IOError, OSError) as err:
+                    logging.warning('OSError: ' + str(err))
+                    continue
+                done.append(file_name)
+                if size >= self.member_size:
+                    end = self.__write_member(index, archive, archive_name, end, records, done)
+                    records = []
+                    size = 0
+                    done = []
+            if done:
+                end = self.__write_member(index, archive, archive_name, end, records, done)
+        return end
+
+    def __write_member(self, index, archive, archive_name, offset, records, file_names):
+        """Writes one gzip member, its index entry and removes the archived files.
+        @return end of the member in the archive
+        """
+        data = ''.join(records)
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        member = compressor.compress(data) + compressor.flush()
+        archive.write(member)
+        archive.flush()
+        os.fsync(archive.fileno())
+        timestamps = []
+        origins = set()
+        for timestamp, frame in iter_records(data):
+            timestamps.append(timestamp)
+            origins.add(index_origin(frame_origin(frame)))
+        entry = {'archive' : archive_name, 'offset' : offset, 'length' : len(member),
+                 'records' : len(timestamps), 'origins' : sorted(origins),
+                 'start' : min(timestamps) if timestamps else None,
+                 'end' : max(timestamps) if timestamps else None}
+        index.write(json.dumps(entry, sort_keys=True) + '\n')
+        index.flush()
+        os.fsync(index.fileno())
+        for file_name in file_names:
+            try:
+                os.remove(file_name)
+            except OSError as err:
+                logging.warning('OSError: ' + str(err))
+        logging.info('Archived ' + str(len(file_names)) + ' files in ' + archive_name)
+        return offset + len(member)
+
+    def entries(self, start=None, end=None, origin=None):
+        """Reads the index.
+        @param start: if set, only members with records at or after this time
+        @param end: if set, only members with records before this time
+        @param origin: if set, only members with frames of this origin
+        @return list of index entries (dictionaries)
+        """
+        entries = []
+        try:
+            with open(self.index_name) as index:
+                for line in index:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # line of an interrupted write
+                        continue
+                    if entry['records'] and (start is not None and entry['end'] < start or
+                                             end is not None and entry['start'] >= end):
+                        continue
+                    if origin is not None and index_origin(origin) not in entry['origins']:
+                        continue
+                    entries.append(entry)
+        except IOError:  # no index yet
+            pass
+        return entries
+
+    def records(self, start=None, end=None, origin=None):
+        """Reads archived records, decompressing only members matching the query.
+        @param start: if set, only records at or after this time
+        @param end: if set, only records before this time
+        @param origin: if set, only frames of this origin ('' for frames without origin)
+        @return generator of (timestamp, frame) tuples in archive order
+        """
+        for entry in self.entries(start, end, origin):
+            with open(os.path.join(self.path, entry['archive']), 'rb') as archive:
+                archive.seek(entry['offset'])
+                data = zlib.decompress(archive.read(entry['length']), 16 + zlib.MAX_WBITS)
+            for timestamp, frame in iter_records(data):
+                if start is not None and timestamp < start or \
+                        end is not None and timestamp >= end:
+                    continue
+                if origin is not None and frame_origin(frame) != origin:
+                    continue
+                yield timestamp, frame
+
+def index_origin(origin):
+    """Origins are byte strings in any encoding. Decoded as latin-1, which maps
+    every byte, they can be stored in the JSON index and compared to it.
+    @return origin as unicode
+    """
+    return origin.decode('latin-1') if isinstance(origin, str) else origin
+
+def iter_records(data):
+    """Splits plain queue records.
+    @param data: binary String of records without CRC
+    @return generator of (timestamp, frame) tuples
+    """
+    pos = 0
+    header_size = RECORD_HEADER.size
+    while pos + header_size <= len(data):
+        timestamp, length = RECORD_HEADER.unpack_from(data, pos)
+        pos += header_size
+        yield timestamp, data[pos:pos + length]
+        pos += length
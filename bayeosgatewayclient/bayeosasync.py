@@ -0,0 +1,190 @@
+"""Non-blocking BayEOSWriter and BayEOSSender for event loop based programs.
+
+Python 2 has no asyncio. Blocking file and HTTP I/O is therefore run on a
+shared pool of worker threads and completion is reported back to the
+event loop through a pipe, so many devices can share a few threads.
+"""
+
+import os
+import logging
+from collections import deque
+from threading import Lock
+from Queue import Queue, Empty
+from multiprocessing.pool import ThreadPool
+try:
+    import fcntl
+except ImportError:  # not a POSIX platform, the pipe stays blocking
+    fcntl = None
+from bayeosgatewayclient import BayEOSWriter, BayEOSSender, DEFAULTS
+from bayeosqueue import QueueWatcher
+
+class BayEOSExecutor(object):
+    """Runs blocking calls on a pool of worker threads."""
+
+    def __init__(self, workers=4):
+        """Creates an executor.
+        @param workers: number of worker threads shared by all devices
+        """
+        self.pool = ThreadPool(workers)
+        # one inotify instance for the queue directories of all senders, see AsyncBayEOSSender
+        self.watcher = QueueWatcher(None)
+        self.__done = Queue()
+        self.__serial = {}
+        self.__lock = Lock()
+        self.__read_fd, self.__write_fd = os.pipe()
+        self.__signals = 0  # bytes written to the pipe and not read yet
+        if fcntl:
+            for fd in (self.__read_fd, self.__write_fd):
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        """File descriptor which is readable when callbacks are ready to dispatch.
+        Register it with select(), poll() or the event loop of your choice.
+        """
+        return self.__read_fd
+
+    def submit(self, func, args=(), kwargs={}, callback=None, serial=None):
+        """Runs func(*args, **kwargs) on a worker thread.
+        @param callback: called as callback(result, error) by dispatch()
+        @param serial: calls with the same serial key run one after another in order
+        """
+        call = (func, args, kwargs, callback)
+        if serial is None:
+            self.pool.apply_async(self.__run, call)
+            return
+        with self.__lock:
+            if serial in self.__serial:
+                self.__serial[serial].append(call)
+                return
+            self.__serial[serial] = deque([call])
+        self.pool.apply_async(self.__run_serial, (serial,))
+
+    def pending(self, serial):
+        """@return True while calls with this serial key are queued or running"""
+        return serial in self.__serial
+
+    def __run(self, func, args, kwargs, callback):
+        """Executes a call on a worker thread and queues its callback."""
+        try:
+            result, error = func(*args, **kwargs), None
+        except Exception as err:
+            logging.warning('Exception in ' + getattr(func, '__name__', str(func)) + ': ' + str(err))
+            result, error = None, err
+        if callback:
+            self.__done.put((callback, result, error))
+            try:
+                os.write(self.__write_fd, 'x')
+            except OSError:  # pipe is full, dispatch() is due anyway
+                pass
+            else:
+                with self.__lock:
+                    self.__signals += 1
+
+    def __run_serial(self, serial):
+        """Executes the queued calls of one serial key until none is left."""
+        while True:
+            with self.__lock:
+                calls = self.__serial[serial]
+                if not calls:
+                    del self.__serial[serial]
+                    return
+                call = calls[0]
+            self.__run(*call)
+            with self.__lock:
+                calls.popleft()
+
+    def dispatch(self):
+        """Runs the callbacks of finished calls in the calling thread.
+        @return number of callbacks run
+        """
+        # reads only the bytes known to be there, so a blocking pipe does not block
+        with self.__lock:
+            signals, self.__signals = self.__signals, 0
+        while signals > 0:
+            try:
+                data = os.read(self.__read_fd, signals)
+            except OSError:
+                break
+            if not data:
+                break
+            signals -= len(data)
+        count = 0
+        while True:
+            try:
+                callback, result, error = self.__done.get_nowait()
+            except Empty:
+                return count
+            callback(result, error)
+            count += 1
+
+    def close(self):
+        """Waits for submitted calls and stops the worker threads."""
+        self.pool.close()
+        self.pool.join()
+        self.dispatch()
+        self.watcher.close()
+        os.close(self.__read_fd)
+        os.close(self.__write_fd)
+
+class AsyncBayEOSWriter(object):
+    """BayEOSWriter whose save methods return immediately."""
+
+    def __init__(self, executor, path=DEFAULTS['path'], **options):
+        """Creates a writer running on an executor.
+        @param executor: BayEOSExecutor shared by many devices
+        @param path: path of queue directory
+        @param options: further keyword arguments for BayEOSWriter
+        """
+        self.executor = executor
+        self.writer = BayEOSWriter(path, **options)
+
+    def __submit(self, method, args, kwargs):
+        callback = kwargs.pop('callback', None)
+        self.executor.submit(method, args, kwargs, callback, serial=self)
+
+    def save(self, *args, **kwargs):
+        """Queues BayEOSWriter.save(), optional keyword callback(result, error)."""
+        self.__submit(self.writer.save, args, kwargs)
+
+    def save_many(self, *args, **kwargs):
+        """Queues BayEOSWriter.save_many(), optional keyword callback(result, error)."""
+        self.__submit(self.writer.save_many, args, kwargs)
+
+    def save_msg(self, *args, **kwargs):
+        """Queues BayEOSWriter.save_msg(), optional keyword callback(result, error)."""
+        self.__submit(self.writer.save_msg, args, kwargs)
+
+    def save_frame(self, *args, **kwargs):
+        """Queues BayEOSWriter.save_frame(), optional keyword callback(result, error)."""
+        self.__submit(self.writer.save_frame, args, kwargs)
+
+    def flush(self, callback=None):
+        """Queues BayEOSWriter.flush()."""
+        self.__submit(self.writer.flush, (), {'callback' : callback})
+
+class AsyncBayEOSSender(object):
+    """BayEOSSender whose send method returns immediately."""
+
+    def __init__(self, executor, path=DEFAULTS['path'], name=DEFAULTS['name'],
+                 url=DEFAULTS['url'], **options):
+        """Creates a sender running on an executor.
+        @param executor: BayEOSExecutor shared by many devices
+        @param path: path where BayEOSWriter puts files
+        @param name: sender name
+        @param url: gateway url e.g. http://<gateway>/gateway/frame/saveFlat
+        @param options: further keyword arguments for BayEOSSender, by default the
+        senders of an executor share its QueueWatcher
+        """
+        self.executor = executor
+        options.setdefault('watcher', executor.watcher)
+        self.sender = BayEOSSender(path, name, url, **options)
+
+    def send(self, callback=None):
+        """Starts BayEOSSender.send() unless a send is still running.
+        @param callback: called as callback(number of posted frames, error)
+        @return False if a send was still running
+        """
+        if self.executor.pending(self):
+            return False
+        self.executor.submit(self.sender.send, callback=callback, serial=self)
+        return True
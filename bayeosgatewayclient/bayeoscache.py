@@ -0,0 +1,183 @@
+"""Cache of the encoded frames of queue files that failed to send.
+
+A retry of a file normally reads it again, wraps every record in a Timestamp
+Frame and base64 encodes it. PayloadCache keeps these encoded frames in memory,
+least recently used first evicted, and optionally spills evicted entries to
+files in a directory, so a retry only posts the bytes again.
+
+Entries are keyed by the base name, mtime and size of a queue file, so they
+survive the move of an unsent file to backup_path, and a rewritten file
+never hits a stale entry.
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from glob import glob
+from hashlib import md5
+
+SPILL_SUFFIX = '.b64'
+
+def payload_key(file_name, origin=None):
+    """@return cache key of a queue file, None if the file does not exist"""
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return (os.path.basename(file_name), stat.st_mtime, stat.st_size, origin or '')
+
+class PayloadCache(object):
+    """LRU cache of lists of base64 encoded frames, bounded in bytes."""
+
+    def __init__(self, max_bytes=4194304, spill_path=None, max_spill_bytes=67108864):
+        """Creates a cache.
+        @param max_bytes: maximum size of the cached frames in memory
+        @param spill_path: if set, entries evicted from memory are written to files in this
+        directory and read from there on a later hit
+        @param max_spill_bytes: maximum size of the spill files, the oldest are removed first
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()  # key : (frames, size), most recently used last
+        self.__lock = threading.Lock()
+        self.spill_path = None
+        self.max_spill_bytes = max_spill_bytes
+        self.spill_size = 0
+        self.__spilled = OrderedDict()  # spill file name : size, oldest first
+        if spill_path:
+            self.spill_path = os.path.abspath(spill_path)
+            if not os.path.isdir(self.spill_path):
+                os.makedirs(self.spill_path, 0700)
+            self.__load_spilled()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def hit_rate(self):
+        """@return share of lookups answered from the cache, None before the first lookup"""
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else None
+
+    def get(self, key):
+        """Looks up the frames of a file, in memory first, then in the spill files.
+        @return list of base64 encoded frames or None
+        """
+        if key is None:
+            return None
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.__entries[key] = entry
+                self.hits += 1
+                return entry[0]
+        frames = self.__read_spilled(key)
+        with self.__lock:
+            if frames is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return frames
+
+    def put(self, key, frames):
+        """Caches the frames of a file that failed to send."""
+        if key is None or not frames:
+            return
+        size = sum(len(frame) for frame in frames)
+        if size > self.max_bytes:
+            self.__spill(key, frames)
+            return
+        evicted = []
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.__entries[key] = (frames, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                old_key, (old_frames, old_size) = self.__entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append((old_key, old_frames))
+        for old_key, old_frames in evicted:
+            self.__spill(old_key, old_frames)
+
+    def discard(self, key):
+        """Drops the entry of a sent file from memory and the spill files."""
+        if key is None:
+            return
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+        if self.spill_path:
+            self.__remove_spilled(self.__spill_name(key))
+
+    def __spill_name(self, key):
+        """@return spill file name of a key"""
+        name, mtime, size, origin = key
+        digest = md5(repr(mtime) + origin).hexdigest()[:12]
+        return os.path.join(self.spill_path, '%s-%d-%s%s' % (name, size, digest, SPILL_SUFFIX))
+
+    def __spill(self, key, frames):
+        """Writes evicted frames to a spill file, one base64 frame per line."""
+        if not self.spill_path:
+            return
+        file_name = self.__spill_name(key)
+        tmp_name = file_name + '.tmp'
+        data = '\n'.join(frames)
+        try:
+            with open(tmp_name, 'wb') as spill:
+                spill.write(data)
+            os.rename(tmp_name, file_name)
+        except (IOError, OSError) as err:
+            logging.warning('Could not spill payload: ' + str(err))
+            return
+        with self.__lock:
+            self.spill_size += len(data) - self.__spilled.pop(file_name, 0)
+            self.__spilled[file_name] = len(data)
+            expired = []
+            while self.spill_size > self.max_spill_bytes and len(self.__spilled) > 1:
+                old_name, old_size = self.__spilled.popitem(last=False)
+                self.spill_size -= old_size
+                expired.append(old_name)
+        for old_name in expired:
+            try:
+                os.remove(old_name)
+            except OSError as err:
+                logging.warning('OSError: ' + str(err))
+
+    def __read_spilled(self, key):
+        """@return frames of a spill file or None"""
+        if not self.spill_path:
+            return None
+        file_name = self.__spill_name(key)
+        if file_name not in self.__spilled:
+            return None
+        try:
+            with open(file_name, 'rb') as spill:
+                return spill.read().split('\n')
+        except IOError:  # removed in the meantime
+            return None
+
+    def __remove_spilled(self, file_name):
+        with self.__lock:
+            size = self.__spilled.pop(file_name, None)
+            if size is None:
+                return
+            self.spill_size -= size
+        try:
+            os.remove(file_name)
+        except OSError as err:
+            logging.warning('OSError: ' + str(err))
+
+    def __load_spilled(self):
+        """Registers spill files left by an earlier run, oldest first."""
+        for tmp_name in glob(os.path.join(self.spill_path, '*' + SPILL_SUFFIX + '.tmp')):
+            os.remove(tmp_name)
+        file_names = glob(os.path.join(self.spill_path, '*' + SPILL_SUFFIX))
+        for file_name in sorted(file_names, key=os.path.getmtime):
+            size = os.path.getsize(file_name)
+            self.__spilled[file_name] = size
+            self.spill_size += size
@@ -0,0 +1,185 @@
+"""Decodes collections of queue files (.rd, .bak) into columns.
+
+Files are decoded in parallel by a process pool. Only a bounded window
+of files is in flight, so memory use does not grow with the number of files.
+
+    python -m bayeosgatewayclient.bayeosexport -f csv -o data.csv /tmp/bayeos-device1
+    python -m bayeosgatewayclient.bayeosexport -f npz -o chunks/ /tmp/bayeos-device1
+"""
+
+import os
+import sys
+import csv
+import logging
+import argparse
+from glob import glob
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from bayeosframe import decode_frame
+from bayeosqueue import QueueFileReader, queue_file_key
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# file endings expanded from directories
+QUEUE_FILE_PATTERNS = ('*.rd', '*.bak')
+
+def expand_paths(paths):
+    """Replaces directories by the queue files they contain.
+    @param paths: list of file or directory names
+    @return list of file names, files of a directory sorted by their start time
+    """
+    file_names = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for pattern in QUEUE_FILE_PATTERNS:
+                found += glob(os.path.join(path, pattern))
+            file_names += sorted(found, key=queue_file_key)
+        else:
+            file_names.append(path)
+    return file_names
+
+def decode_file(file_name):
+    """Decodes all frames of a queue file into columns.
+    Rows are aligned: row i of every column belongs to the same frame.
+    @return dictionary with lists 'timestamp', 'origin', 'type', 'message', a dictionary
+    'values' of channel : list (None where a frame has no such channel) and the
+    number of 'invalid' frames
+    """
+    timestamps = []
+    origins = []
+    types = []
+    messages = []
+    values = {}
+    invalid = 0
+    try:
+        with QueueFileReader(file_name) as reader:
+            for timestamp, frame in reader:
+                try:
+                    record = decode_frame(frame, timestamp)
+                except ValueError:
+                    invalid += 1
+                    continue
+                row = len(timestamps)
+                timestamps.append(record.timestamp)
+                origins.append(record.origin)
+                types.append(record.type)
+                messages.append(record.message)
+                if record.values:
+                    for channel, value in record.values.iteritems():
+                        column = values.get(channel)
+                        if column is None:
+                            column = values[channel] = [None] * row
+                        column.append(value)
+                for column in values.itervalues():
+                    if len(column) == row:
+                        column.append(None)
+    except (IOError, OSError) as err:
+        logging.warning('OSError: ' + str(err))
+    if invalid:
+        logging.warning(str(invalid) + ' invalid frames in ' + file_name)
+    return {'file' : file_name, 'timestamp' : timestamps, 'origin' : origins,
+            'type' : types, 'message' : messages, 'values' : values, 'invalid' : invalid}
+
+def decode_files(file_names, processes=None, window=None):
+    """Decodes queue files in parallel, yielding the results in file order.
+    @param file_names: list of queue files
+    @param processes: number of worker processes, default number of CPUs, 1 decodes in-process
+    @param window: maximum number of files decoded ahead, default 4 per process
+    @return generator of column dictionaries as returned by decode_file
+    """
+    processes = processes or cpu_count()
+    if processes == 1:
+        for file_name in file_names:
+            yield decode_file(file_name)
+        return
+    window = window or 4 * processes
+    pool = Pool(processes)
+    try:
+        file_names = iter(file_names)
+        while True:
+            batch = list(islice(file_names, window))
+            if not batch:
+                break
+            for columns in pool.imap(decode_file, batch):
+                yield columns
+    finally:
+        pool.terminate()
+
+def to_arrays(columns):
+    """Converts the columns of decode_file into NumPy arrays.
+    Missing channel values are NaN.
+    @return dictionary of arrays 'timestamp', 'origin', 'type' and 'channel_<key>'
+    """
+    if numpy is None:
+        raise ImportError('NumPy is required for array output.')
+    arrays = {'timestamp' : numpy.array(columns['timestamp'], dtype=numpy.float64),
+              'origin' : numpy.array(columns['origin'], dtype=str),
+              'type' : numpy.array(columns['type'], dtype=numpy.uint8)}
+    if any(message is not None for message in columns['message']):
+        arrays['message'] = numpy.array([message or '' for message in columns['message']],
+                                        dtype=str)
+    for channel, column in columns['values'].iteritems():
+        arrays['channel_' + str(channel)] = numpy.array(
+            [numpy.nan if value is None else value for value in column], dtype=numpy.float64)
+    return arrays
+
+def write_csv(chunks, output):
+    """Writes columns in long format: one line per channel value or message.
+    @param chunks: iterable of column dictionaries as returned by decode_file
+    @param output: file object
+    @return number of written lines
+    """
+    writer = csv.writer(output)
+    writer.writerow(('timestamp', 'origin', 'type', 'channel', 'value'))
+    lines = 0
+    for columns in chunks:
+        channels = sorted(columns['values'].items())
+        for row, timestamp in enumerate(columns['timestamp']):
+            origin = columns['origin'][row]
+            frame_type = columns['type'][row]
+            if columns['message'][row] is not None:
+                writer.writerow((repr(timestamp), origin, frame_type, '', columns['message'][row]))
+                lines += 1
+            for channel, column in channels:
+                if column[row] is not None:
+                    writer.writerow((repr(timestamp), origin, frame_type, channel, repr(column[row])))
+                    lines += 1
+    return lines
+
+def write_npz(chunks, path):
+    """Writes every chunk of columns to a NumPy file chunk-<number>.npz in path.
+    @return number of written files
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    count = 0
+    for columns in chunks:
+        numpy.savez(os.path.join(path, 'chunk-%06d.npz' % count), **to_arrays(columns))
+        count += 1
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description='Decodes BayEOS queue files into columns.')
+    parser.add_argument('paths', nargs='+', help='queue files or directories')
+    parser.add_argument('-f', '--format', choices=('csv', 'npz'), default='csv',
+                        help='csv: one line per value, npz: one NumPy file per queue file')
+    parser.add_argument('-o', '--output', help='CSV file (default stdout) or directory for npz')
+    parser.add_argument('-p', '--processes', type=int, help='number of worker processes')
+    args = parser.parse_args()
+
+    chunks = decode_files(expand_paths(args.paths), args.processes)
+    if args.format == 'npz':
+        if numpy is None:
+            parser.error('npz output requires NumPy.')
+        write_npz(chunks, args.output or '.')
+    elif args.output:
+        with open(args.output, 'wb') as output:
+            write_csv(chunks, output)
+    else:
+        write_csv(chunks, sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,10 @@
 """Implementation of BayEOS Frame Protocol Specification."""
 
-from struct import pack, unpack
+from struct import pack, unpack, Struct, error as StructError
 from time import time
 from datetime import datetime
 from abc import abstractmethod
+from collections import namedtuple
 
 REFERENCE_TIME_DIF = (datetime(2000, 1, 1) -
                               datetime(1970, 1, 1)).total_seconds()
@@ -56,11 +57,15 @@ class BayEOSFrame(object):
             print 'Error in to_object method: ' + str(err)
 
     @staticmethod
-    def parse_frame(frame,res={'origin':'','timestamp':time()}):
+    def parse_frame(frame,res=None):
         """Parses a binary coded BayEOS Frame into a Python dictionary.
+        See decode_frame for a faster parser.
         @param frame: binary coded String
+        @param res: dictionary to fill, by default with empty origin and current time
         @return Python dictionary
         """
+        if res is None:
+            res = {'origin':'','timestamp':time()}
         try:
             bayeos_frame = BayEOSFrame.to_object(frame)
             bayeos_frame.frame = frame
@@ -153,6 +158,85 @@ class DataFrame(BayEOSFrame):
         res['type']=0x1
         return res
 
+class DataFrameEncoder(object):
+    """Encodes Data Frames of a fixed channel layout with one precompiled Struct."""
+    def __init__(self, value_type=0x41, channels=1, offset=0):
+        """Compiles the frame layout.
+        @param value_type: defines Offset and Data Type
+        @param channels: number of channels or list of channel indices or labels
+        @param offset: length of Channel Offset (if Offset Type is 0x0)
+        """
+        if isinstance(channels, (int, long)):
+            channels = range(1, channels + 1)
+        self.channels = tuple(channels)
+        self.value_type = int(value_type)
+        offset_type = (0xf0 & self.value_type)
+        data_type = (0x0f & self.value_type)
+        try:
+            val_format = DATA_TYPES[data_type]['format'][1:]
+        except KeyError as err:
+            raise ValueError('Data Type ' + str(err) + ' is not defined.')
+
+        header = [0x1, self.value_type]
+        if offset_type == 0x0:  # Data Frame with channel offset
+            header.append(offset)
+        frame_format = '<' + 'B' * len(header)
+        template = []
+        if offset_type == 0x40:  # Data Frame with channel indices
+            for key in self.channels:
+                frame_format += 'B' + val_format
+                template += [int(key), None]
+            self.__stride = 2
+        elif offset_type == 0x60:  # labeled channel type
+            for key in self.channels:
+                label = str(key)
+                frame_format += 'B' + str(len(label)) + 's' + val_format
+                template += [len(label), label, None]
+            self.__stride = 3
+        else:
+            frame_format += val_format * len(self.channels)
+            self.__stride = 1
+        self.__header = tuple(header)
+        self.__template = header + template
+        self.__first = len(header) + self.__stride - 1
+        compiled = Struct(frame_format)
+        self.__pack = compiled.pack
+        self.size = compiled.size
+
+    def encode(self, values):
+        """Encodes one row of values.
+        @param values: list of values in channel order or dictionary with channel keys
+        @return binary coded Data Frame
+        """
+        if isinstance(values, dict):
+            values = [values[key] for key in self.channels]
+        if self.__stride == 1:
+            return self.__pack(*(self.__header + tuple(values)))
+        args = self.__template[:]
+        args[self.__first::self.__stride] = values
+        return self.__pack(*args)
+
+    @staticmethod
+    def layout(values):
+        """Splits values as accepted by DataFrame.create into channels and values.
+        @param values: list, tuple or dictionary with channel number keys
+        @return tuple of channel keys and list of values
+        """
+        if isinstance(values, dict):
+            return tuple(values.keys()), values.values()
+        channels = []
+        row = []
+        key = 1
+        for value in values:
+            if type(value) is tuple or type(value) is list:
+                channels.append(value[0])
+                row.append(value[1])
+            else:
+                channels.append(key)
+                row.append(value)
+            key += 1
+        return tuple(channels), row
+
 class CommandFrame(BayEOSFrame):
     """Command and Command Response Frame Factory class."""
     def create(self, cmd_type, cmd):
@@ -363,11 +447,11 @@ class ChecksumFrame(BayEOSFrame):
         res['validChecksum']=(checksum==0xffff)
         return BayEOSFrame.parse_frame(self.frame[1:-2],res)
 
-DATA_TYPES = {0x1 : {'format' : '<f', 'length' : 4},  # float32 4 bytes
-              0x2 : {'format' : '<i', 'length' : 4},  # int32 4 bytes
-              0x3 : {'format' : '<h', 'length' : 2},  # int16 2 bytes
-              0x4 : {'format' : '<b', 'length' : 1},  # int8 1 byte
-              0x5 : {'format' : '<q', 'length' : 8}}  # double 8 bytes
+DATA_TYPES = {0x1 : {'format' : '<f', 'length' : 4, 'dtype' : '<f4'},  # float32 4 bytes
+              0x2 : {'format' : '<i', 'length' : 4, 'dtype' : '<i4'},  # int32 4 bytes
+              0x3 : {'format' : '<h', 'length' : 2, 'dtype' : '<i2'},  # int16 2 bytes
+              0x4 : {'format' : '<b', 'length' : 1, 'dtype' : '<i1'},  # int8 1 byte
+              0x5 : {'format' : '<q', 'length' : 8, 'dtype' : '<i8'}}  # double 8 bytes
 
 FRAME_TYPES = {0x1: {'name' : 'Data Frame',
                      'class' : DataFrame},
@@ -403,4 +487,144 @@ FRAME_TYPES = {0x1: {'name' : 'Data Frame',
 # swaps keys and values in FRAME_TYPES Dictionary
 # FRAME_NAMES = {value['name']:key for key, value in FRAME_TYPES.iteritems()}
 # for key, value in FRAME_NAMES.iteritems():
-#     print key, value
\ No newline at end of file
+#     print key, value
+
+
+class FrameRecord(namedtuple('FrameRecord', 'type origin timestamp delay rssi valid_checksum '
+                               'values message cmd_type cmd binary pos')):
+    """Result of decode_frame. Fields not present in the frame are None."""
+    __slots__ = ()
+
+    def to_dict(self):
+        """@return dictionary of all fields which are set"""
+        return dict((name, value) for name, value in zip(self._fields, self)
+                    if value is not None)
+
+_SHORTS = Struct('<hh')
+_ROUTED_RSSI = Struct('<hhB')
+_LONG = Struct('<l')
+_LONG_LONG = Struct('<q')
+_CHECKSUM = Struct('<H')
+_BINARY = Struct('<f')
+# (value_type, number of values) : Struct of the values of a Data Frame
+_DATA_STRUCTS = {}
+
+def _data_struct(value_type, count):
+    """Compiles and caches the Struct for count values of a Data Frame."""
+    try:
+        val_format = DATA_TYPES[value_type & 0x0f]['format'][1:]
+    except KeyError:
+        raise ValueError('Data Type ' + hex(value_type & 0x0f) + ' is not defined.')
+    if value_type & 0xf0 == 0x40:
+        val_format = 'B' + val_format
+    compiled = _DATA_STRUCTS[(value_type, count)] = Struct('<' + val_format * count)
+    return compiled
+
+def _decode_values(frame, pos, end):
+    """Decodes the payload of a Data Frame starting at its Value Type.
+    @return dictionary of channel keys and values
+    """
+    value_type = ord(frame[pos])
+    offset_type = value_type & 0xf0
+    try:
+        length = DATA_TYPES[value_type & 0x0f]['length']
+    except KeyError:
+        raise ValueError('Data Type ' + hex(value_type & 0x0f) + ' is not defined.')
+    pos += 1
+    if offset_type == 0x60:  # labeled channels
+        values = {}
+        val_struct = _DATA_STRUCTS.get((value_type & 0x0f, 1)) or _data_struct(value_type & 0x0f, 1)
+        while pos < end:
+            label_end = pos + 1 + ord(frame[pos])
+            values[frame[pos + 1:label_end]] = val_struct.unpack_from(frame, label_end)[0]
+            pos = label_end + length
+        if pos > end:
+            raise ValueError('Truncated Data Frame')
+        return values
+    key = 0
+    if offset_type == 0x0:
+        key = ord(frame[pos])
+        pos += 1
+    elif offset_type == 0x40:
+        length += 1
+    count, rest = divmod(end - pos, length)
+    if rest:
+        raise ValueError('Truncated Data Frame')
+    data = (_DATA_STRUCTS.get((value_type, count)) or _data_struct(value_type, count)).unpack_from(frame, pos)
+    if offset_type == 0x40:
+        return dict(zip(data[0::2], data[1::2]))
+    return dict(zip(xrange(key + 1, key + 1 + count), data))
+
+def decode_frame(frame, timestamp=None, origin=''):
+    """Decodes a binary coded BayEOS Frame in a single pass without recursion.
+    Unlike parse_frame, timestamps are Unix epoch seconds and Delayed Frames are
+    subtracted from the timestamp of an enclosing or the given timestamp.
+    @param frame: binary coded String, buffer or memoryview
+    @param timestamp: Unix epoch time the frame was received, if known
+    @param origin: origin of the sender
+    @return FrameRecord
+    @raise ValueError: if the frame is truncated or of unknown type
+    """
+    if isinstance(frame, memoryview):  # slices of a memoryview are no Strings
+        frame = frame.tobytes()
+    pos = 0
+    end = len(frame)
+    delay = 0
+    rssi = valid_checksum = values = message = cmd_type = cmd = binary = binary_pos = None
+    try:
+        while True:
+            frame_type = ord(frame[pos])
+            if frame_type == 0xc:  # Timestamp Frame (ms)
+                timestamp = _LONG_LONG.unpack_from(frame, pos + 1)[0] / 1000.0
+                delay = 0
+                pos += 9
+            elif frame_type == 0xb or frame_type == 0xd:  # (routed) Origin Frame
+                length = ord(frame[pos + 1])
+                name = frame[pos + 2:pos + 2 + length]
+                if frame_type == 0xb:
+                    origin = name
+                else:
+                    origin += '/' + name
+                pos += 2 + length
+            elif frame_type == 0xf:  # Checksum Frame
+                checksum = sum(bytearray(frame[pos:end - 2])) + \
+                    _CHECKSUM.unpack_from(frame, end - 2)[0]
+                # nested Checksum Frames are only valid if all checksums match
+                valid_checksum = checksum & 0xffff == 0xffff and valid_checksum is not False
+                end -= 2
+                pos += 1
+            elif frame_type == 0x7:  # Delayed Frame
+                delay += _LONG.unpack_from(frame, pos + 1)[0]
+                pos += 5
+            elif frame_type == 0x9:  # Timestamp Frame (s)
+                timestamp = _LONG.unpack_from(frame, pos + 1)[0] + REFERENCE_TIME_DIF
+                delay = 0
+                pos += 5
+            elif frame_type == 0x6 or frame_type == 0x8:  # Routed (RSSI) Frame
+                if frame_type == 0x6:
+                    my_id, pan_id = _SHORTS.unpack_from(frame, pos + 1)
+                    pos += 5
+                else:
+                    my_id, pan_id, rssi = _ROUTED_RSSI.unpack_from(frame, pos + 1)
+                    pos += 6
+                origin += '/XBee%d:%d' % (pan_id, my_id)
+            else:
+                break
+        if frame_type == 0x1:
+            values = _decode_values(frame, pos + 1, end)
+        elif frame_type == 0x4 or frame_type == 0x5:
+            message = frame[pos + 1:end]
+        elif frame_type == 0x2 or frame_type == 0x3 or frame_type == 0xe:
+            cmd_type = ord(frame[pos + 1])
+            cmd = frame[pos + 2:end]
+        elif frame_type == 0xa:
+            binary_pos = _BINARY.unpack_from(frame, pos + 1)[0]
+            binary = frame[pos + 5:end]
+        else:
+            raise ValueError('Frame Type ' + hex(frame_type) + ' not found.')
+    except (IndexError, StructError):
+        raise ValueError('Truncated frame')
+    if delay and timestamp is not None:
+        timestamp -= delay / 1000.0
+    return FrameRecord(frame_type, origin, timestamp, delay, rssi, valid_checksum,
+                       values, message, cmd_type, cmd, binary, binary_pos)
@@ -0,0 +1,207 @@
+"""Lightweight stand-in for a BayEOS Gateway to load and latency test senders.
+
+Speaks the saveFlat protocol: a form-encoded POST with basic auth, the
+sender name and base64 coded frames in bayeosframes[]. Latency, error
+codes and dropped connections can be injected.
+
+    python -m bayeosgatewayclient.bayeosgateway --port 5533 --latency 0.2 --error-rate 0.1
+"""
+
+import base64
+import socket
+import logging
+import argparse
+import threading
+import zlib
+import BaseHTTPServer
+import SocketServer
+from random import random
+from time import sleep, time
+from urlparse import parse_qs
+from bayeosframe import decode_frame
+
+class GatewayRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles saveFlat POSTs for BayEOSGatewayEmulator."""
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1  # one send per response, avoids delayed ACK stalls
+
+    def do_POST(self):
+        gateway = self.server
+        start = time()
+        body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        if gateway.latency or gateway.jitter:
+            sleep(gateway.latency + random() * gateway.jitter)
+        if gateway.drop_rate and random() < gateway.drop_rate:
+            gateway.count(dropped=1)
+            self.close_connection = 1
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        if not gateway.authorized(self.headers.get('authorization')):
+            self.respond(401)
+            return
+        if gateway.error_rate and random() < gateway.error_rate:
+            self.respond(gateway.error_code)
+            return
+        try:
+            encoding = self.headers.get('content-encoding')
+            if encoding == 'gzip':
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            elif encoding == 'deflate':
+                body = zlib.decompress(body)
+            form = parse_qs(body)
+        except zlib.error:
+            self.respond(400)
+            return
+        sender = form.get('sender', [''])[0]
+        frames = form.get('bayeosframes[]', [])
+        invalid = 0
+        if gateway.validate:
+            for frame in frames:
+                if not gateway.valid_frame(frame):
+                    invalid += 1
+        gateway.count(sender, frames=len(frames), invalid=invalid, bytes=len(body),
+                      latency=time() - start)
+        self.respond(200)
+
+    def respond(self, code):
+        """Sends an empty response and counts its status code."""
+        self.server.count(status=code)
+        self.send_response(code)
+        self.send_header('content-length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class BayEOSGatewayEmulator(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server emulating the saveFlat interface of a BayEOS Gateway."""
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0, user='import', password='import',
+                 latency=0, jitter=0, error_rate=0, error_code=500, drop_rate=0,
+                 validate=True):
+        """Creates the emulator.
+        @param host: address to listen on
+        @param port: port to listen on, 0 picks a free port
+        @param user: user name for basic auth, None accepts every request
+        @param password: password for basic auth
+        @param latency: seconds every request is delayed
+        @param jitter: maximum random seconds added to latency
+        @param error_rate: fraction of requests answered with error_code
+        @param error_code: HTTP status code of injected errors
+        @param drop_rate: fraction of connections closed without response
+        @param validate: if True every frame is decoded with decode_frame
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), GatewayRequestHandler)
+        self.user = user
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.drop_rate = drop_rate
+        self.validate = validate
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.reset()
+
+    @property
+    def url(self):
+        """saveFlat URL of the emulator"""
+        return 'http://%s:%d/gateway/frame/saveFlat' % self.server_address[:2]
+
+    def start(self):
+        """Serves requests in a background thread."""
+        self.__thread = threading.Thread(target=self.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+        logging.info('Gateway emulator listening on ' + self.url)
+
+    def stop(self):
+        """Stops serving and closes the socket."""
+        self.shutdown()
+        self.server_close()
+
+    def authorized(self, header):
+        """Checks a basic auth header."""
+        if self.user is None:
+            return True
+        return header == 'Basic ' + base64.b64encode(self.user + ':' + self.password)
+
+    def valid_frame(self, frame):
+        """Decodes a base64 coded frame.
+        @return True if it could be decoded and its checksum (if any) is valid
+        """
+        try:
+            return decode_frame(base64.b64decode(frame)).valid_checksum is not False
+        except (TypeError, ValueError):
+            return False
+
+    def count(self, sender=None, status=None, **counters):
+        """Adds to the statistics."""
+        with self.__lock:
+            for key, value in counters.items():
+                if key == 'latency':
+                    self.__stats['max_latency'] = max(self.__stats['max_latency'], value)
+                    key = 'total_latency'
+                self.__stats[key] += value
+            if status is not None:
+                self.__stats['requests'] += 1
+                self.__stats['status'][status] = self.__stats['status'].get(status, 0) + 1
+            if sender is not None:
+                self.__stats['senders'][sender] = \
+                    self.__stats['senders'].get(sender, 0) + counters.get('frames', 0)
+
+    def reset(self):
+        """Clears the statistics."""
+        with self.__lock:
+            self.__stats = {'requests' : 0, 'frames' : 0, 'invalid' : 0, 'bytes' : 0,
+                            'dropped' : 0, 'total_latency' : 0.0, 'max_latency' : 0.0,
+                            'status' : {}, 'senders' : {}}
+            self.__started = time()
+
+    def stats(self):
+        """@return snapshot of the statistics including throughput since reset()"""
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['status'] = dict(stats['status'])
+            stats['senders'] = len(stats['senders'])
+            elapsed = time() - self.__started
+        accepted = stats['status'].get(200, 0)
+        latency = stats.pop('total_latency')
+        stats['elapsed'] = elapsed
+        stats['frames_per_sec'] = stats['frames'] / elapsed if elapsed else 0
+        stats['requests_per_sec'] = stats['requests'] / elapsed if elapsed else 0
+        stats['mean_latency'] = latency / accepted if accepted else 0
+        return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a stand-in BayEOS Gateway.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=5533, help='port to listen on')
+    parser.add_argument('--user', default='import', help='user for basic auth')
+    parser.add_argument('--password', default='import', help='password for basic auth')
+    parser.add_argument('--latency', type=float, default=0, help='delay per request [seconds]')
+    parser.add_argument('--jitter', type=float, default=0, help='random extra delay [seconds]')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of error responses')
+    parser.add_argument('--error-code', type=int, default=500, help='status code of errors')
+    parser.add_argument('--drop-rate', type=float, default=0, help='fraction of dropped connections')
+    parser.add_argument('--no-validate', action='store_true', help='do not parse frames')
+    parser.add_argument('--interval', type=float, default=10, help='statistics interval [seconds]')
+    args = parser.parse_args()
+
+    gateway = BayEOSGatewayEmulator(args.host, args.port, args.user, args.password,
+                                    args.latency, args.jitter, args.error_rate,
+                                    args.error_code, args.drop_rate, not args.no_validate)
+    gateway.start()
+    print 'Listening on ' + gateway.url
+    try:
+        while True:
+            sleep(args.interval)
+            print gateway.stats()
+    except KeyboardInterrupt:
+        gateway.stop()
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,41 @@
 """bayeosgatewayclient"""
-import os, string, base64, re
+import os, base64, re, zlib
+from urllib import urlencode
 from os import rename
 from tempfile import gettempdir
-from struct import pack, unpack
+from struct import pack, error as StructError
 from socket import gethostname
 from time import sleep, time
+from random import random
 from glob import glob
-from bayeosframe import BayEOSFrame
+from heapq import heappush, heappop
+from bayeosframe import BayEOSFrame, DataFrameEncoder, DATA_TYPES
+from bayeosqueue import QueueFileReader, QueueWatcher, QueueIndex, SegmentStore, QueueQuota, \
+    notify_queue, queue_file_key, frame_origin, pack_record, recover_queue, CRC_MAGIC
+from bayeosmetrics import Metrics, queue_depth
+from bayeosarchive import BackupArchive
+from bayeoscache import PayloadCache, payload_key
+from bayeosschedule import TickScheduler, monotonic
 from abc import abstractmethod
 from multiprocessing import Process
-from threading import Thread
+from multiprocessing.pool import ThreadPool
+from threading import Thread, Lock, Timer
 from thread import start_new_thread
 from shutil import move
 import argparse
 import ConfigParser
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    from urllib3.util.retry import Retry
 import tempfile
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.WARNING)
 
@@ -34,7 +53,75 @@ DEFAULTS = {'path' : gettempdir(),
             'absolute_time' : True,
             'remove' : True,
             'sleep_between_children' : 0,
-            'backup_path' : None}
+            'backup_path' : None,
+            'buffer_frames' : 1,
+            'buffer_bytes' : 0,
+            'buffer_time' : 0,
+            'durability' : 'flush',
+            'pool_size' : 10,
+            'retries' : 0,
+            'backoff_factor' : 0,
+            'batch_bytes' : 0,
+            'batch_frames' : 0,
+            'workers' : 1,
+            'ordering' : 'strict',
+            'compression' : None,
+            'watch' : True,
+            'queue_index' : True,
+            'inotify' : True,
+            'store' : 'files',
+            'segment_size' : 1048576,
+            'max_queue_bytes' : 0,
+            'max_backup_bytes' : 0,
+            'eviction' : 'oldest',
+            'thin_factor' : 2,
+            'origin_priorities' : None,
+            'crc' : False,
+            'archive_path' : None,
+            'archive_partition' : 'day',
+            'archive_interval' : 3600,
+            'breaker_threshold' : 3,
+            'breaker_backoff' : 5,
+            'breaker_max_backoff' : 600,
+            'probe_timeout' : 5,
+            'payload_cache_bytes' : 4194304,
+            'payload_spill_path' : None,
+            'shared_sender' : False,
+            'spread_ticks' : True,
+            'hub_processes' : 1,
+            'hub_workers' : 4}
+
+# 'none': leave writes to the OS, 'flush': flush after every write,
+# 'fsync': additionally fsync each file before it is renamed to .rd
+DURABILITY_MODES = ('none', 'flush', 'fsync')
+
+# 'strict': files are posted one after another in queue order,
+# 'origin': files sharing an origin are posted in order, others concurrently,
+# 'none': all files are posted concurrently
+ORDERING_MODES = ('strict', 'origin', 'none')
+
+def gzip_encode(body, level=6):
+    """Compresses a request body in gzip format."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+def deflate_encode(body, level=6):
+    """Compresses a request body in zlib (HTTP deflate) format."""
+    return zlib.compress(body, level)
+
+# Content-Encodings for request bodies, may be extended by name : function(body)
+CONTENT_ENCODINGS = {'gzip' : gzip_encode,
+                     'deflate' : deflate_encode}
+
+def gateway_unavailable(status_code):
+    """@return True if a response status means the gateway cannot take frames at the moment"""
+    return status_code >= 500 or status_code in (408, 429)
+
+# number of cached Data Frame layouts per writer
+MAX_ENCODERS = 64
+
+# frames per POST of a sender with devices if neither batch_frames nor batch_bytes is set
+DEVICE_BATCH_FRAMES = 1000
 
 def bayeos_argparser(description = ''):
     """Parses command line arguments useful for this package.
@@ -79,58 +166,260 @@ def bayeos_confparser(config_file):
         print str(e) + '. Config File not found or corrupt.'
     return config
 
+def _check_range(values, dtype):
+    """Checks that an array can be cast to an integer dtype without wrapping.
+    Raises the errors struct.pack raises for the same values.
+    """
+    dtype = numpy.dtype(dtype)
+    if dtype.kind not in 'iu' or not values.size:
+        return
+    if values.dtype.kind == 'f' and not numpy.isfinite(values).all():
+        raise ValueError('cannot convert float NaN or infinity to integer')
+    limits = numpy.iinfo(dtype)
+    if values.min() < limits.min or values.max() > limits.max:
+        raise StructError('%s format requires %d <= number <= %d' % (dtype, limits.min, limits.max))
+
 class BayEOSWriter(object):
     """Writes BayEOSFrames to file."""
     
     def __init__(self, path=DEFAULTS['path'], max_chunk=DEFAULTS['max_chunk'],
-                 max_time=DEFAULTS['max_time'],log_level=logging.INFO):
+                 max_time=DEFAULTS['max_time'],log_level=logging.INFO,
+                 buffer_frames=DEFAULTS['buffer_frames'],
+                 buffer_bytes=DEFAULTS['buffer_bytes'],
+                 buffer_time=DEFAULTS['buffer_time'],
+                 durability=DEFAULTS['durability'],
+                 store=DEFAULTS['store'],
+                 segment_size=DEFAULTS['segment_size'],
+                 max_queue_bytes=DEFAULTS['max_queue_bytes'],
+                 eviction=DEFAULTS['eviction'],
+                 thin_factor=DEFAULTS['thin_factor'],
+                 origin_priorities=DEFAULTS['origin_priorities'],
+                 crc=DEFAULTS['crc']):
         """Constructor for a BayEOSWriter instance.
         @param path: path of queue directory
         @param max_chunk: maximum file size in Bytes, when reached a new file is started
         @param max_time: maximum time when a new file is started
         @param log_level: log level according to logging package
+        @param buffer_frames: number of frames collected before they are written to file
+        @param buffer_bytes: if set, buffered frames are written when this size in Bytes is reached
+        @param buffer_time: if set, buffered frames are written at the latest this many seconds
+        after the first of them was saved, also if no further frame is saved
+        @param durability: 'none', 'flush' (flush after every write) or 'fsync' (fsync on rollover)
+        @param store: 'files' (one .rd file per chunk) or 'segments' (SegmentStore)
+        @param segment_size: size of a segment file in bytes, if store is 'segments'
+        @param max_queue_bytes: if set, queue files in path are evicted above this size
+        @param eviction: 'oldest', 'thin' or 'origin', see QueueQuota
+        @param thin_factor: every thin_factor-th frame is kept by the 'thin' eviction
+        @param origin_priorities: dictionary origin : priority for the 'origin' eviction
+        @param crc: if True every record is protected by a CRC32 (not with segments)
         """
         logging.getLogger().setLevel(log_level)
         self.path = os.path.abspath(path)
         self.max_chunk = max_chunk
         self.max_time = max_time
+        self.buffer_frames = max(1, buffer_frames)
+        self.buffer_bytes = buffer_bytes
+        self.buffer_time = buffer_time
+        if durability not in DURABILITY_MODES:
+            logging.warning('Unknown durability ' + str(durability) + '. Using flush.')
+            durability = 'flush'
+        self.durability = durability
+        self.__buffer = []
+        self.__buffer_size = 0
+        self.__buffer_since = 0
+        self.__timer = None  # writes the buffer after buffer_time
+        self.__lock = Lock()  # buffer and file are also written by the timer thread
+        self.__encoders = {}
+        self.__sequence = 0
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.rollovers = 0
+        self.metrics = Metrics('writer', {'path' : self.path})
+        self.metrics.counter('frames', lambda: self.frames_written)
+        self.metrics.counter('bytes', lambda: self.bytes_written)
+        self.metrics.counter('rollovers', lambda: self.rollovers)
+        self.metrics.gauge('buffered_frames', lambda: len(self.__buffer))
         if not os.path.isdir(self.path):
             try:
                 os.makedirs(self.path, 0700)
             except OSError as err:
                 logging.critical('OSError: ' + str(err) + ' Could not create dir.')
                 exit()
-        files = glob(os.path.join(self.path,'*.act'))
-        for each_file in files:
-            try:
-                rename(each_file, each_file.replace('.act', '.rd'))
-            except OSError as err:
-                logging.warning('OSError: ' + str(err))
-        self.__start_new_file()
+        # .act files left by a crashed writer are cut behind their last valid record
+        self.recovered = recover_queue(self.path)
+        self.crc = crc and store != 'segments'
+        self.store = store
+        self.quota = None
+        if max_queue_bytes and store != 'segments':
+            self.quota = QueueQuota(self.path, max_queue_bytes, eviction,
+                                    thin_factor, origin_priorities)
+        self.metrics.counter('recovered_files', lambda: len(self.recovered))
+        self.metrics.counter('recovered_bytes_cut', lambda: sum(lost for each_file, records, lost
+                                                                in self.recovered))
+        if self.quota:
+            self.metrics.counter('evicted_frames', lambda: self.quota.evicted_frames)
+            self.metrics.counter('evicted_files', lambda: self.quota.evicted_files)
+            self.metrics.counter('evicted_bytes', lambda: self.quota.evicted_bytes)
+        if store == 'segments':
+            self.__segments = SegmentStore(self.path, segment_size)
+            self.current_timestamp = time()
+            self.file_size = 0
+        else:
+            self.__segments = None
+            self.__start_new_file()
 
     def __save_frame(self, frame, timestamp=0):
         """Saves frames to file.
         @param frame: must be a valid BayEOS Frame as a binary coded String
         @param timestamp: Unix epoch time stamp, if zero system time is used
         """
+        if not frame:
+            logging.warning('Empty frame not saved.')
+            return
         if not timestamp:
             timestamp = time()
-        frame_length = len(frame)
-        if self.file.tell() + frame_length + 10 > self.max_chunk or time() - self.current_timestamp > self.max_time:
-            self.flush()
-            
-        self.file.write(pack('<d', timestamp) + pack('<h', frame_length) + frame)
-        self.file.flush()
+        record = pack_record(timestamp, frame, self.crc)
+        with self.__lock:
+            if self.__needs_rollover(len(record)):
+                self.__flush()
+
+            self.frames_written += 1
+            self.__buffer.append(record)
+            self.__buffer_size += len(record)
+            self.file_size += len(record)
+            if not self.__buffer_since:
+                self.__buffer_since = time()
+            if len(self.__buffer) >= self.buffer_frames or \
+                (self.buffer_bytes and self.__buffer_size >= self.buffer_bytes) or \
+                (self.buffer_time and time() - self.__buffer_since >= self.buffer_time):
+                self.__write_buffer()
+            elif self.buffer_time and self.__timer is None:
+                self.__timer = Timer(self.buffer_time, self.__write_due)
+                self.__timer.daemon = True
+                self.__timer.start()
         logging.debug('Frame saved.')
 
+    def __write_due(self):
+        """Writes the buffer when buffer_time passed without a further save."""
+        with self.__lock:
+            self.__write_buffer()
+
+    def __save_records(self, records):
+        """Writes a batch of queue records with one write call per file.
+        @param records: list of binary coded records (timestamp, length, frame)
+        """
+        with self.__lock:
+            self.__write_buffer()
+            self.frames_written += len(records)
+            batch = []
+            batch_size = 0
+            for record in records:
+                if self.__needs_rollover(batch_size + len(record)):
+                    if batch:
+                        self.__write(''.join(batch))
+                        self.file_size += batch_size
+                        batch = []
+                        batch_size = 0
+                    self.__flush()
+                batch.append(record)
+                batch_size += len(record)
+            if batch:
+                self.__write(''.join(batch))
+                self.file_size += batch_size
+        logging.debug(str(len(records)) + ' frames saved.')
+
+    def __needs_rollover(self, length):
+        """Checks whether a new file has to be started before writing.
+        @param length: number of bytes to be written
+        @return True if max_chunk or max_time would be exceeded
+        """
+        if self.__segments:
+            return False
+        return self.file_size + length > self.max_chunk or \
+            time() - self.current_timestamp > self.max_time
+
+    def __write_buffer(self):
+        """Writes all buffered records to the current file. Callers hold the lock."""
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        if not self.__buffer:
+            return
+        self.__write(''.join(self.__buffer))
+        self.__buffer = []
+        self.__buffer_size = 0
+        self.__buffer_since = 0
+
+    def __write(self, data):
+        """Writes data to the current file according to durability setting."""
+        self.bytes_written += len(data)
+        if self.__segments:
+            self.__segments.append(data)
+            return
+        self.file.write(data)
+        if self.durability != 'none':
+            self.file.flush()
 
     def __start_new_file(self):
         """Opens a new file with ending .act and determines current file name."""
         self.current_timestamp = time()
-        [sec, usec] = string.split(str(self.current_timestamp), '.')        
-        [fd, self.current_name] = tempfile.mkstemp('.act',sec + '-' + usec + '-',self.path)
+        [fd, self.current_name] = self.__mkstemp(self.current_timestamp)
         os.close(fd)
         self.file = open(self.current_name, 'wb')
+        self.file_size = 0
+        if self.crc:
+            self.file.write(CRC_MAGIC)
+            self.file_size = len(CRC_MAGIC)
+
+    def __mkstemp(self, timestamp):
+        """Creates a new .act file named after the given time in microseconds and
+        a sequence number, which orders files started at the same time (see queue_file_key).
+        @return tuple of an OS-level file handle and the absolute file name
+        """
+        self.__sequence += 1
+        sec = int(timestamp)
+        usec = min(999999, int((timestamp - sec) * 1e6))
+        return tempfile.mkstemp('.act', '%d-%06d-%d-' % (sec, usec, self.__sequence), self.path)
+
+    def __publish(self, file_name):
+        """Renames a closed .act file to .rd, so it is ready for post."""
+        try:
+            p = (file_name+'$$__end_key__$$').replace('.act$$__end_key__$$','.rd')                 
+            rename(file_name, p)
+            logging.debug('File '+ p + ' ready for post')
+        except OSError as err:
+            logging.warning(str(err) + '. Could not find file: ' + file_name )
+            return
+        if self.quota:
+            self.quota.add(os.path.getsize(p))
+        notify_queue(self.path, p)
+
+    def __wrap_origin(self, frame, origin=None, routed=False):
+        """Wraps a frame in an (routed) Origin Frame if origin is given.
+        @return binary coded frame
+        """
+        if not origin:
+            return frame
+        if routed:
+            origin_frame = BayEOSFrame.factory(0xd)
+        else:
+            origin_frame = BayEOSFrame.factory(0xb)
+        origin_frame.create(origin=origin, nested_frame=frame)
+        return origin_frame.frame
+
+    def __data_frame(self, values, value_type=0x41, offset=0):
+        """Encodes a Data Frame reusing a cached encoder for its channel layout.
+        @return binary coded Data Frame
+        """
+        channels, row = DataFrameEncoder.layout(values)
+        key = (value_type, offset, channels)
+        encoder = self.__encoders.get(key)
+        if encoder is None:
+            if len(self.__encoders) >= MAX_ENCODERS:
+                self.__encoders.clear()
+            encoder = DataFrameEncoder(value_type, channels, offset)
+            self.__encoders[key] = encoder
+        return encoder.encode(row)
 
     def save(self, values, value_type=0x41, offset=0, timestamp=0, origin=None, routed=False):
         """Generic frame saving method.
@@ -141,14 +430,33 @@ class BayEOSWriter(object):
         @param origin: if defined, it is used as a name
         @param routed: only relevant with origin - if true, routed origin is created
         """
-        data_frame = BayEOSFrame.factory(0x1)
-        data_frame.create(values, value_type, offset)
-        if not origin:
-            self.__save_frame(data_frame.frame, timestamp)
-        else:
-            origin_frame = BayEOSFrame.factory(0xb)
-            origin_frame.create(origin=origin, nested_frame=data_frame.frame)
-            self.__save_frame(origin_frame.frame, timestamp)
+        try:
+            frame = self.__data_frame(values, value_type, offset)
+        except ValueError as err:
+            logging.warning('Could not create Data Frame: ' + str(err))
+            return
+        self.__save_frame(self.__wrap_origin(frame, origin, routed), timestamp)
+
+    def save_many(self, rows, value_type=0x41, offset=0, origin=None, routed=False):
+        """Saves a batch of Data Frames with a single write per file.
+        @param rows: list of (values, timestamp) tuples, values as in save()
+        @param value_type: defines Offset and Data Type
+        @param offset: defines Channel Offset
+        @param origin: if defined, it is used as a name
+        @param routed: only relevant with origin - if true, routed origin is created
+        @return number of saved frames, 0 if a row could not be encoded
+        """
+        records = []
+        for values, timestamp in rows:
+            try:
+                frame = self.__data_frame(values, value_type, offset)
+            except ValueError as err:
+                logging.warning('Could not create Data Frame: ' + str(err))
+                return 0
+            frame = self.__wrap_origin(frame, origin, routed)
+            records.append(pack_record(timestamp or time(), frame, self.crc))
+        self.__save_records(records)
+        return len(records)
 
     def save_msg(self, message, error=False, timestamp=0, origin=None, routed=False):
         """Saves Messages or Error Messages to Gateway.
@@ -163,39 +471,122 @@ class BayEOSWriter(object):
         else:
             msg_frame = BayEOSFrame.factory(0x4)  # instantiate Message Frame
         msg_frame.create(message)
-        if not origin:
-            self.__save_frame(msg_frame.frame, timestamp)
-        else:
-            origin_frame = BayEOSFrame.factory(0xb)
-            origin_frame.create(origin=origin, nested_frame=msg_frame.frame)
-            self.__save_frame(origin_frame.frame, timestamp)
+        self.__save_frame(self.__wrap_origin(msg_frame.frame, origin, routed), timestamp)
             
     def save_frame(self, frame, timestamp=0, origin=None, routed=False):
         """Saves a BayEOS Frame either as it is or wrapped in an Origin Frame."""
-        if not origin:
-            self.__save_frame(frame, timestamp); 
-        else:
-            if routed:
-                origin_frame = BayEOSFrame.factory(0xd)
-            else:   
-                origin_frame = BayEOSFrame.factory(0xb)
-            origin_frame.create(origin=origin, nested_frame=frame)
-            self.__save_frame(origin_frame.frame, timestamp)
+        self.__save_frame(self.__wrap_origin(frame, origin, routed), timestamp)
 
     def flush(self):
         """Close the current used file and renames it from .act to .rd.
-        Starts a new file.
+        Starts a new file. With a SegmentStore buffered records are written
+        and senders are notified.
         """
+        with self.__lock:
+            self.__flush()
+
+    def __flush(self):
+        """Implements flush(). Callers hold the lock."""
         logging.info('Flushed writer.')
+        self.__write_buffer()
+        if self.__segments:
+            if self.durability == 'fsync':
+                self.__segments.sync()
+            notify_queue(self.path)
+            return
+        if self.durability == 'fsync':
+            self.file.flush()
+            os.fsync(self.file.fileno())
         self.file.close()
-        try:
-            p = (self.current_name+'$$__end_key__$$').replace('.act$$__end_key__$$','.rd')                 
-            rename(self.current_name, p)
-            logging.debug('File '+ p + ' ready for post')
-        except OSError as err:
-            logging.warning(str(err) + '. Could not find file: ' + self.current_name )
+        self.__publish(self.current_name)
+        self.rollovers += 1
         self.__start_new_file()
 
+    def save_array(self, timestamps, matrix, value_type=0x41, offset=0, indices=None):
+        """Saves the rows of a 2-D array as Data Frames directly into .rd files.
+        Uses NumPy if available, otherwise or with crc the rows are passed to save_many().
+        @param timestamps: Unix epoch time stamps, one per row
+        @param matrix: array of shape (rows, channels)
+        @param value_type: defines Offset and Data Type
+        @param offset: defines Channel Offset
+        @param indices: channel indices for Offset Type 0x40, default 1, 2, ...
+        @return number of saved frames
+        """
+        offset_type = (0xf0 & value_type)
+        if numpy is None or offset_type == 0x60 or self.crc:
+            rows = []
+            for timestamp, row in zip(timestamps, matrix):
+                if indices and offset_type == 0x40:
+                    row = zip(indices, row)
+                rows.append((list(row), timestamp))
+            return self.save_many(rows, value_type, offset)
+
+        timestamps = numpy.asarray(timestamps, dtype='<f8')
+        matrix = numpy.asarray(matrix)
+        if matrix.ndim != 2 or matrix.shape[0] != timestamps.shape[0]:
+            raise ValueError('Need one row of values per timestamp.')
+        try:
+            value_dtype = DATA_TYPES[0x0f & value_type]['dtype']
+        except KeyError as err:
+            raise ValueError('Data Type ' + str(err) + ' is not defined.')
+        channels = matrix.shape[1]
+        if indices is None:
+            indices = range(1, channels + 1)
+        # astype() wraps values silently, save_many() rejects them
+        try:
+            _check_range(matrix, value_dtype)
+        except ValueError as err:
+            logging.warning('Could not create Data Frame: ' + str(err))
+            return 0
+        if offset_type == 0x40:
+            _check_range(numpy.asarray(indices), 'u1')
+        elif offset_type == 0x0:
+            _check_range(numpy.asarray([offset]), 'u1')
+
+        # one structured record per row: <d timestamp, <h length, frame
+        fields = [('timestamp', '<f8'), ('length', '<i2'),
+                  ('frame_type', 'u1'), ('value_type', 'u1')]
+        if offset_type == 0x0:
+            fields.append(('offset', 'u1'))
+        if offset_type == 0x40:
+            for i in range(channels):
+                fields += [('i' + str(i), 'u1'), ('v' + str(i), value_dtype)]
+        else:
+            fields.append(('values', value_dtype, (channels,)))
+        records = numpy.zeros(timestamps.shape[0], dtype=fields)
+        records['timestamp'] = timestamps
+        records['length'] = records.dtype.itemsize - 10
+        records['frame_type'] = 0x1
+        records['value_type'] = value_type
+        if offset_type == 0x0:
+            records['offset'] = offset
+        if offset_type == 0x40:
+            for i in range(channels):
+                records['i' + str(i)] = indices[i]
+                records['v' + str(i)] = matrix[:, i]
+        else:
+            records['values'] = matrix
+
+        self.frames_written += records.shape[0]
+        if self.__segments:
+            with self.__lock:
+                self.__write_buffer()
+                self.__write(records.tobytes())
+            return records.shape[0]
+        per_file = max(1, int(self.max_chunk // records.dtype.itemsize))
+        for start in range(0, records.shape[0], per_file):
+            [fd, name] = self.__mkstemp(time())
+            try:
+                os.write(fd, records[start:start + per_file].tobytes())
+                if self.durability == 'fsync':
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.bytes_written += len(records[start:start + per_file]) * records.dtype.itemsize
+            self.__publish(name)
+        logging.debug(str(records.shape[0]) + ' frames saved.')
+        return records.shape[0]
+
 class BayEOSSender(object):
     """Sends content of BayEOS writer files to Gateway."""
     def __init__(self, path=DEFAULTS['path'], 
@@ -206,7 +597,35 @@ class BayEOSSender(object):
                  absolute_time=DEFAULTS['absolute_time'],
                  remove=DEFAULTS['remove'],
                  backup_path=DEFAULTS['backup_path'],
-                 log_level=logging.INFO):
+                 log_level=logging.INFO,
+                 pool_size=DEFAULTS['pool_size'],
+                 retries=DEFAULTS['retries'],
+                 backoff_factor=DEFAULTS['backoff_factor'],
+                 batch_bytes=DEFAULTS['batch_bytes'],
+                 batch_frames=DEFAULTS['batch_frames'],
+                 workers=DEFAULTS['workers'],
+                 ordering=DEFAULTS['ordering'],
+                 compression=DEFAULTS['compression'],
+                 watch=DEFAULTS['watch'],
+                 queue_index=DEFAULTS['queue_index'],
+                 inotify=DEFAULTS['inotify'],
+                 store=DEFAULTS['store'],
+                 segment_size=DEFAULTS['segment_size'],
+                 max_backup_bytes=DEFAULTS['max_backup_bytes'],
+                 eviction=DEFAULTS['eviction'],
+                 thin_factor=DEFAULTS['thin_factor'],
+                 origin_priorities=DEFAULTS['origin_priorities'],
+                 archive_path=DEFAULTS['archive_path'],
+                 archive_partition=DEFAULTS['archive_partition'],
+                 archive_interval=DEFAULTS['archive_interval'],
+                 devices=None,
+                 breaker_threshold=DEFAULTS['breaker_threshold'],
+                 breaker_backoff=DEFAULTS['breaker_backoff'],
+                 breaker_max_backoff=DEFAULTS['breaker_max_backoff'],
+                 probe_timeout=DEFAULTS['probe_timeout'],
+                 payload_cache_bytes=DEFAULTS['payload_cache_bytes'],
+                 payload_spill_path=DEFAULTS['payload_spill_path'],
+                 watcher=None):
         """Constructor for BayEOSSender instance.
         @param path: path where BayEOSWriter puts files
         @param name: sender name
@@ -217,6 +636,43 @@ class BayEOSSender(object):
         @param remove: if set to false files are kept as .bak file in the BayEOSWriter directory
         @param backup_path: path 
         @param log_level: log level according to logging package
+        @param pool_size: number of keep-alive connections held per gateway host
+        @param retries: number of connection retries or a urllib3 Retry object
+        @param backoff_factor: factor for the sleep time between retries
+        @param batch_bytes: if set, several files are posted at once up to this payload size
+        @param batch_frames: if set, several files are posted at once up to this number of frames
+        @param workers: number of concurrent uploads, ignored for strict ordering
+        @param ordering: 'strict', 'origin' or 'none'
+        @param compression: Content-Encoding of the request body, e.g. 'gzip' or 'deflate'
+        @param watch: if True run() wakes up as soon as the writer finished a file
+        @param queue_index: if True files in path are taken from a QueueIndex instead of globbing
+        @param inotify: if False only writers of the same process are noticed by watch and
+        queue_index, which saves an inotify instance per sender
+        @param store: 'files' or 'segments', must match the BayEOSWriter
+        @param segment_size: size of a segment file in bytes, if store is 'segments'
+        @param max_backup_bytes: if set, files in backup_path are evicted above this size
+        @param eviction: 'oldest', 'thin' or 'origin', see QueueQuota
+        @param thin_factor: every thin_factor-th frame is kept by the 'thin' eviction
+        @param origin_priorities: dictionary origin : priority for the 'origin' eviction
+        @param archive_path: if set, .bak files are rolled into a BackupArchive in this directory
+        @param archive_partition: 'hour', 'day' or 'month', time span of one archive file
+        @param archive_interval: minimum seconds between two archive runs
+        @param devices: dictionary origin : queue directory of further writers, sent through
+        this sender with their frames wrapped in Origin Frames. Unsent files and archives
+        of a device are kept in subdirectories of backup_path and archive_path named after
+        the queue directory
+        @param breaker_threshold: number of consecutive failed POSTs that open the circuit,
+        0 disables the circuit breaker
+        @param breaker_backoff: seconds the circuit stays open the first time, doubled on
+        every failed probe
+        @param breaker_max_backoff: upper bound of the open time in seconds
+        @param probe_timeout: timeout in seconds of the health probe that closes the circuit
+        @param payload_cache_bytes: if set, the encoded frames of files that failed to send are
+        kept up to this size for their retry, only used with absolute_time
+        @param payload_spill_path: if set, frames evicted from the payload cache are kept in
+        files in this directory
+        @param watcher: QueueWatcher shared by several senders, which then use one inotify
+        instance; wait() also wakes up for files of the other senders
         """
         if not password:
             exit('No gateway password was found.')
@@ -227,6 +683,30 @@ class BayEOSSender(object):
         self.user = user
         self.absolute_time = absolute_time
         self.remove = remove
+        self.batch_bytes = batch_bytes
+        self.batch_frames = batch_frames
+        if ordering not in ORDERING_MODES:
+            logging.warning('Unknown ordering ' + str(ordering) + '. Using strict.')
+            ordering = 'strict'
+        self.ordering = ordering
+        if compression and compression not in CONTENT_ENCODINGS:
+            logging.warning('Unknown compression ' + str(compression) + '. Sending uncompressed.')
+            compression = None
+        self.compression = compression
+        self.workers = max(1, workers)
+        self.__pool = None
+        self.__origins = {}  # payload_key : origins of the files grouped by __origin_lanes
+        self.watch = watch
+        self.__watcher = None
+        self.queue_index = queue_index
+        self.inotify = inotify
+        self.shared_watcher = watcher
+        self.__index = None
+        self.store = store
+        self.segment_size = segment_size
+        self.__segments = None
+        self.metrics = Metrics('sender', {'path' : self.path, 'name' : name})
+        self.metrics.gauge('queue', lambda: queue_depth(self.path))
         logging.getLogger().setLevel(log_level)
         if backup_path and not os.path.isdir(backup_path):
             try:
@@ -235,41 +715,373 @@ class BayEOSSender(object):
                 logging.warning('OSError: ' + str(err))
             backup_path=os.path.abspath(backup_path)
         self.backup_path = backup_path
+        self.backup_quota = None
+        if backup_path and max_backup_bytes:
+            self.backup_quota = QueueQuota(backup_path, max_backup_bytes, eviction,
+                                           thin_factor, origin_priorities)
+            self.metrics.counter('backup_evicted_frames', lambda: self.backup_quota.evicted_frames)
+            self.metrics.counter('backup_evicted_files', lambda: self.backup_quota.evicted_files)
+            self.metrics.counter('backup_evicted_bytes', lambda: self.backup_quota.evicted_bytes)
+        self.backup_archive = None
+        if archive_path:
+            self.backup_archive = BackupArchive(archive_path, archive_partition)
+        self.archive_interval = archive_interval
+        self.__archived = 0
+        self.devices = devices or {}
+        self.__device_indexes = {}
+        self.__device_watcher = None
+        self.__device_archives = {}
+        self.__turn = 0
+        self.breaker_threshold = breaker_threshold
+        self.breaker_backoff = breaker_backoff
+        self.breaker_max_backoff = breaker_max_backoff
+        self.probe_timeout = probe_timeout
+        self.failures = 0
+        self.__opened = 0  # consecutive openings, grows the backoff
+        self.__open_until = None
+        self.__breaker_lock = Lock()
+        self.metrics.gauge('circuit_open', lambda: int(self.__open_until is not None))
+        self.payload_cache = None
+        # Delayed Frames depend on the time of sending and cannot be reused
+        if payload_cache_bytes and absolute_time:
+            self.payload_cache = PayloadCache(payload_cache_bytes, payload_spill_path)
+            self.metrics.counter('payload_cache_hits', lambda: self.payload_cache.hits)
+            self.metrics.counter('payload_cache_misses', lambda: self.payload_cache.misses)
+            self.metrics.gauge('payload_cache', lambda: {'entries' : len(self.payload_cache),
+                                                         'bytes' : self.payload_cache.size,
+                                                         'hit_rate' : self.payload_cache.hit_rate()})
+        self.session = self.__create_session(max(pool_size, self.workers), retries, backoff_factor)
 
+    def __create_session(self, pool_size, retries, backoff_factor):
+        """Creates a requests Session with keep-alive connection pool and retry policy.
+        Connection errors are retried, a POST that reached the gateway is not.
+        @return requests Session
+        """
+        if isinstance(retries, (int, long)):
+            retries = Retry(total=retries, connect=retries, read=0,
+                            backoff_factor=backoff_factor)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=retries)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.auth = (self.user, self.password)
+        session.headers['user-agent'] = 'BayEOS-Python-Gateway-Client/0.3.9'
+        return session
+
+    def connection_stats(self):
+        """Counts connections to the gateway.
+        @return dictionary with numbers of requests, opened and reused connections
+        """
+        stats = {'requests' : 0, 'opened' : 0, 'reused' : 0}
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                stats['requests'] += pools[key].num_requests
+                stats['opened'] += pools[key].num_connections
+        stats['reused'] = stats['requests'] - stats['opened']
+        return stats
 
     def send(self):
         """Keeps sending until all files are sent or an error occurs.
         @return number of posted frames as an integer
         """
+        if not self.__circuit_closed():
+            return 0
         count_frames = 0
         try:
             count_frames += self.__send_files(self.path)
         except:
             logging.warning('Send error on __send_files(: ' + self.path + ')')
-        if self.backup_path:
+        if self.backup_path and self.__open_until is None:
             try:
                 count_frames += self.__send_files(self.backup_path)
             except:
                 logging.warning('Send error on __send_files(: ' + self.backup_path + ')')
+        if self.devices and self.__open_until is None:
+            try:
+                count_frames += self.__send_devices()
+            except:
+                logging.warning('Send error on __send_devices()')
+        if self.backup_archive and time() - self.__archived >= self.archive_interval:
+            self.__archived = time()
+            self.__roll_backups()
         return count_frames
 
+    def circuit_delay(self):
+        """@return seconds until the open circuit is probed, 0 if the circuit is closed"""
+        open_until = self.__open_until
+        if open_until is None:
+            return 0
+        return max(0, open_until - monotonic())
+
+    def __circuit_closed(self):
+        """Checks the circuit breaker before any file is read.
+        When the open time has passed, a health probe decides whether the circuit
+        closes or stays open for a longer time.
+        @return True if frames may be posted
+        """
+        if self.__open_until is None:
+            return True
+        if monotonic() < self.__open_until:
+            return False
+        if self.__probe():
+            with self.__breaker_lock:
+                self.failures = 0
+                self.__opened = 0
+                self.__open_until = None
+            logging.warning('Gateway available again. Circuit closed.')
+            return True
+        with self.__breaker_lock:
+            self.__open_circuit()
+        return False
+
+    def __probe(self):
+        """Posts the sender name without frames, which does not require reading files.
+        @return True if the gateway answered and is not overloaded
+        """
+        self.metrics.inc('probes')
+        try:
+            r = self.session.post(self.url, data={'sender': self.name}, timeout=self.probe_timeout)
+        except requests.exceptions.RequestException as err:
+            logging.info('sender probe error: ' + str(err))
+            return False
+        return not gateway_unavailable(r.status_code)
+
+    def __record_failure(self, retry_after=None):
+        """Counts a failed POST and opens the circuit at breaker_threshold failures.
+        @param retry_after: seconds requested by a Retry-After header, a lower bound of the open time
+        """
+        if not self.breaker_threshold:
+            return
+        with self.__breaker_lock:
+            self.failures += 1
+            if self.failures >= self.breaker_threshold and self.__open_until is None:
+                self.__open_circuit(retry_after)
+
+    def __open_circuit(self, retry_after=None):
+        """Opens the circuit for an exponentially growing, jittered time.
+        Callers hold the breaker lock.
+        """
+        backoff = min(self.breaker_max_backoff, self.breaker_backoff * 2 ** self.__opened)
+        # jitter keeps many senders from probing a recovering gateway at the same time
+        backoff *= 0.5 + random() / 2
+        if retry_after:
+            backoff = max(backoff, min(retry_after, self.breaker_max_backoff))
+        self.__opened += 1
+        self.__open_until = monotonic() + backoff
+        self.metrics.inc('circuit_opens')
+        logging.warning('Gateway unavailable. Circuit open for ' + str(round(backoff, 1)) + ' seconds.')
+
+    def __roll_backups(self):
+        """Moves the .bak files of sent frames into the backup archive, those of
+        devices into the archives of the devices.
+        Errors are logged, the files stay for the next run.
+        """
+        paths = [(None, path) for path in filter(None, [self.path, self.backup_path])]
+        for origin in sorted(self.devices):
+            paths.append((origin, self.devices[origin]))
+            if self.backup_path:
+                paths.append((origin, self.__device_backup_path(origin)))
+        for origin, path in paths:
+            try:
+                self.__device_archive(origin).archive(path)
+            except Exception as err:
+                logging.warning('Archive error: ' + str(err))
+
+    def __device_archive(self, origin):
+        """@return BackupArchive of a device, created on first use, or the
+        archive of this sender for origin None
+        """
+        if origin is None:
+            return self.backup_archive
+        if origin not in self.__device_archives:
+            path = os.path.join(self.backup_archive.path, os.path.basename(self.devices[origin]))
+            self.__device_archives[origin] = BackupArchive(path, self.backup_archive.partition)
+        return self.__device_archives[origin]
+
+    def __device_backup_path(self, origin):
+        """@return directory in backup_path for the unsent files of a device"""
+        return os.path.join(self.backup_path, os.path.basename(self.devices[origin]))
+
+    def __move_unsent(self, file_name, backup_path):
+        """Moves a file that could not be sent to a backup directory.
+        @return True if the file was moved
+        """
+        logging.debug('moving ' + file_name + ' to ' + backup_path)
+        try:
+            size = os.path.getsize(file_name)
+            move(file_name, os.path.join(backup_path, os.path.basename(file_name)))
+        except (IOError, OSError) as err:
+            logging.warning('OSError: ' + str(err))
+            return False
+        self.metrics.inc('backup_moves')
+        if self.backup_quota and backup_path == self.backup_path:
+            self.backup_quota.add(size)
+        return True
+
     def __send_files(self, path):
         """Sends all files within one directory.
         @param path: path in file system
         @return number of frames in directory
         """
-        try:
-            files = glob(os.path.join(path,'*.rd'))
-        except OSError as err:
-            logging.warning('OSError: ' + str(err))
-            return 0
+        if self.store == 'segments' and path == self.path:
+            return self.__send_segments()
+        index = None
+        if self.queue_index and path == self.path:
+            index = self.__get_index()
+            files = index.files()
+        else:
+            try:
+                files = sorted(glob(os.path.join(path,'*.rd')), key=queue_file_key)
+            except OSError as err:
+                logging.warning('OSError: ' + str(err))
+                return 0
         
         if len(files) == 0:
             return 0
 
+        if self.workers > 1 and self.ordering != 'strict':
+            count_frames, unsent = self.__send_concurrent(files)
+        else:
+            count_frames, i = self.__send_lane(files)
+            unsent = files[i:]
+        if index:
+            if self.backup_path:  # unsent files are moved to backup_path below
+                index.remove(files)
+            else:
+                unsent_files = set(unsent)
+                index.remove([each_file for each_file in files if each_file not in unsent_files])
+                index.prune(unsent)
+
+        # on post error we did not run to the end
+        # move files to backup_path
+        if self.backup_path and path != self.backup_path:
+            for each_file in unsent:
+                self.__move_unsent(each_file, self.backup_path)
+
+        return count_frames
+
+    def __send_devices(self):
+        """Sends the queue directories of devices, several devices per POST.
+        Files are taken round-robin, one file per device in turn, continuing with the
+        next device on the next POST, so a device with a large backlog cannot starve
+        the others. After a failed POST the queued files are moved to the backup
+        directories of their devices if backup_path is set.
+        @return number of posted frames
+        """
+        origins = sorted(self.devices)
+        queues = dict((origin, self.__device_files(origin)) for origin in origins)
+        max_frames = self.batch_frames or (0 if self.batch_bytes else DEVICE_BATCH_FRAMES)
+        count_frames = 0
+        while True:
+            batch = []
+            frames = []
+            size = 0
+            idle = 0
+            while idle < len(origins):
+                origin = origins[self.__turn % len(origins)]
+                files = queues[origin]
+                if not files:
+                    idle += 1
+                    self.__turn += 1
+                    continue
+                try:
+                    key, file_frames = self.__encoded_frames(files[0], origin)
+                except (IOError, OSError):  # already sent by someone else
+                    self.__forget_device_file(origin, files.pop(0))
+                    continue
+                file_size = sum(len(frame) for frame in file_frames)
+                if batch and ((max_frames and len(frames) + len(file_frames) > max_frames) or
+                              (self.batch_bytes and size + file_size > self.batch_bytes)):
+                    break
+                batch.append((origin, files.pop(0), key, file_frames))
+                frames += file_frames
+                size += file_size
+                idle = 0
+                self.__turn += 1
+            if not batch:
+                return count_frames
+            if frames and not self.__post(frames):
+                self.__cache_failed([(key, file_frames) for origin, file_name, key, file_frames in batch])
+                if self.backup_path:
+                    unsent = [(origin, file_name) for origin, file_name, key, file_frames in batch]
+                    for origin in origins:
+                        unsent += [(origin, file_name) for file_name in queues[origin]]
+                    self.__backup_device_files(unsent)
+                return count_frames
+            for origin, file_name, key, file_frames in batch:
+                if not file_frames:
+                    self.__move_to_backup(file_name)
+                elif os.path.isfile(file_name):
+                    self.__archive(file_name, key)
+                self.__forget_device_file(origin, file_name)
+            count_frames += len(frames)
+
+    def __device_index(self, origin):
+        """@return QueueIndex of the queue directory of a device, created on first use.
+        The indexes of all devices share one inotify instance.
+        """
+        if origin not in self.__device_indexes:
+            path = self.devices[origin]
+            if self.__device_watcher is None:
+                self.__device_watcher = QueueWatcher(path, self.inotify)
+            self.__device_indexes[origin] = QueueIndex(path, self.inotify, self.__device_watcher)
+        return self.__device_indexes[origin]
+
+    def __forget_device_file(self, origin, file_name):
+        """Removes a sent or vanished file from the QueueIndex of a device."""
+        if self.queue_index and not self.__in_device_backup(origin, file_name):
+            self.__device_index(origin).remove([file_name])
+
+    def __in_device_backup(self, origin, file_name):
+        """@return True if a file lies in the backup directory of a device"""
+        return bool(self.backup_path) and \
+            os.path.dirname(file_name) == self.__device_backup_path(origin)
+
+    def __backup_device_files(self, unsent):
+        """Moves files that could not be sent to the backup directories of their devices.
+        @param unsent: list of (origin, file name) tuples
+        """
+        for origin, file_name in unsent:
+            if self.__in_device_backup(origin, file_name):
+                continue
+            backup_path = self.__device_backup_path(origin)
+            if not os.path.isdir(backup_path):
+                try:
+                    os.makedirs(backup_path, 0700)
+                except OSError as err:
+                    logging.warning('OSError: ' + str(err))
+                    return
+            if self.__move_unsent(file_name, backup_path):
+                self.__forget_device_file(origin, file_name)
+
+    def __device_files(self, origin):
+        """@return list of queued files of a device including those in its backup
+        directory, oldest first
+        """
+        if self.queue_index:
+            files = list(self.__device_index(origin).files())
+        else:
+            files = glob(os.path.join(self.devices[origin], '*.rd'))
+        if self.backup_path:
+            files += glob(os.path.join(self.__device_backup_path(origin), '*.rd'))
+        elif self.queue_index:
+            return files
+        return sorted(files, key=queue_file_key)
+
+    def __send_lane(self, files):
+        """Sends files one after another until an error occurs.
+        @param files: list of file names in the order to send
+        @return number of posted frames and number of processed files
+        """
         count_frames = 0
         i = 0
-        while i < len(files):
+        read_ahead = {}  # frames of a file that did not fit into the previous batch
+        while i < len(files) and self.__open_until is None:
+            if not os.path.isfile(files[i]):  # already sent by someone else
+                i += 1
+                continue
             if(os.stat(files[i]).st_size==0):
                 logging.warning('Empty file. Removing')
                 os.remove(files[i])
@@ -277,82 +1089,291 @@ class BayEOSSender(object):
                 continue
 
             try:
-                count = self.__post_file(files[i])
+                if self.batch_bytes or self.batch_frames:
+                    count, consumed = self.__post_batch(files, i, read_ahead)
+                else:
+                    count = self.__post_file(files[i])
+                    consumed = 1 if count else 0
             except:
                 logging.warning('Sender __send_file error on '+ files[i])
-                count=0
+                count = consumed = 0
             
-            if count:
-                i += 1
+            if consumed:
+                i += consumed
                 count_frames += count
             else:
                 break
+        return count_frames, i
 
-        # on post error we did not run to the end
-        # move files to backup_path
-        if self.backup_path and path != self.backup_path:
-            while i < len(files):        
-                logging.debug('moving ' + files[i] + ' to backup_path')
-                try:
-                    move(files[i], files[i].replace(self.path,self.backup_path))
-                except OSError as err:
-                    logging.warning('OSError: ' + str(err))
-                i += 1
+    def __send_concurrent(self, files):
+        """Sends files with a pool of worker threads according to ordering.
+        @param files: list of file names
+        @return number of posted frames and list of files not sent
+        """
+        if self.ordering == 'none':
+            lanes = [[each_file] for each_file in files]
+        else:
+            lanes = self.__origin_lanes(files)
+        if not self.__pool:
+            self.__pool = ThreadPool(self.workers)
+        results = self.__pool.map(self.__send_lane, lanes, 1)
+        count_frames = 0
+        unsent = []
+        for lane, (count, i) in zip(lanes, results):
+            count_frames += count
+            unsent += lane[i:]
+        return count_frames, unsent
+
+    def __origin_lanes(self, files):
+        """Groups files so that files sharing an origin end up in the same lane.
+        The origins of a file are read once and kept while the file is queued, so a
+        backlog is not parsed again on every call.
+        @param files: list of file names
+        @return list of lanes, each a list of file names in queue order
+        """
+        lanes = {}
+        lane_of = {}
+        known = self.__origins
+        self.__origins = {}
+        for index, each_file in enumerate(files):
+            key = payload_key(each_file)
+            origins = known.get(key)
+            if origins is None:
+                origins = self.__file_origins(each_file)
+            if key is not None:
+                self.__origins[key] = origins
+            joined = sorted(set(lane_of[origin] for origin in origins if origin in lane_of))
+            if not joined:
+                lane = index
+                lanes[lane] = []
+            else:
+                lane = joined[0]
+                for other in joined[1:]:
+                    lanes[lane] += lanes.pop(other)
+                    for origin, value in lane_of.items():
+                        if value == other:
+                            lane_of[origin] = lane
+            lanes[lane].append(each_file)
+            for origin in origins:
+                lane_of[origin] = lane
+        return [lanes[lane] for lane in sorted(lanes)]
+
+    def __file_origins(self, file_name):
+        """Determines the origins of the frames in a file.
+        Frames without Origin Frame belong to the sender itself ('').
+        @return set of origin names
+        """
+        origins = set()
+        try:
+            with QueueFileReader(file_name) as reader:
+                for timestamp, frame in reader:
+                    origins.add(frame_origin(frame))
+        except (IOError, OSError) as err:
+            logging.warning('OSError: ' + str(err))
+        return origins
 
-        return count_frames
-    
     def __post_file(self, file_name):
         """Reads one file and tries to send its content to the gateway.
         uses the requests library!!
         On success the file is deleted or renamed to *.bak ending.
         @return number of successfully posted frames in one file
         """
-        current_file = open(file_name, 'rb')  # opens oldest file
-        data={'sender': self.name}
+        key, frames = self.__encoded_frames(file_name)
+        if len(frames)==0:
+            self.__move_to_backup(file_name)
+            return 0
+
+        if not self.__post(frames):
+            self.__cache_failed([(key, frames)])
+            return 0
+        self.__archive(file_name, key)
+        return len(frames)
+
+    def __post_batch(self, file_names, start, read_ahead):
+        """Sends the content of several files in one POST.
+        Files are added until batch_bytes or batch_frames would be exceeded.
+        The files are only deleted or renamed after the POST succeeded.
+        Files removed in the meantime, e.g. by a quota or by hand, are skipped.
+        @param file_names: list of queue files, oldest first
+        @param start: index of the first file of the batch in file_names
+        @param read_ahead: dictionary file name : (cache key, frames) of files read before,
+        the file that does not fit into this batch is added
+        @return number of successfully posted frames and number of processed files,
+        0 processed files if the POST failed
+        """
+        batch = []
+        frames = []
+        size = 0
+        for i in xrange(start, len(file_names)):
+            file_name = file_names[i]
+            try:
+                key, file_frames = read_ahead.pop(file_name, None) or self.__encoded_frames(file_name)
+            except (IOError, OSError):  # vanished, processed without frames
+                batch.append((file_name, None, []))
+                continue
+            file_size = sum(len(frame) for frame in file_frames)
+            if batch and ((self.batch_frames and len(frames) + len(file_frames) > self.batch_frames) or
+                          (self.batch_bytes and size + file_size > self.batch_bytes)):
+                read_ahead[file_name] = (key, file_frames)
+                break
+            batch.append((file_name, key, file_frames))
+            if not file_frames:
+                self.__move_to_backup(file_name)
+                continue
+            frames += file_frames
+            size += file_size
+
+        if not frames:
+            return 0, len(batch)
+        if not self.__post(frames):
+            self.__cache_failed([(key, file_frames) for file_name, key, file_frames in batch])
+            return 0, 0
+        for file_name, key, file_frames in batch:
+            if os.path.isfile(file_name):
+                self.__archive(file_name, key)
+        logging.debug('Posted ' + str(len(frames)) + ' frames of ' + str(len(batch)) + ' files.')
+        return len(frames), len(batch)
+
+    def __send_segments(self):
+        """Sends the records of a SegmentStore until all are sent or an error occurs.
+        Sent records are acknowledged instead of deleting files.
+        @return number of posted frames
+        """
+        if not self.__segments:  # created lazily, as start() may fork
+            self.__segments = SegmentStore(self.path, self.segment_size)
+        count_frames = 0
+        while True:
+            records, position = self.__segments.read(self.batch_bytes or DEFAULTS['max_chunk'])
+            if not records:
+                if position != self.__segments.cursor:  # skipped to the next segment
+                    self.__segments.ack(position)
+                return count_frames
+            frames = self.__wrap_frames(records)
+            if not self.__post(frames):
+                return count_frames
+            self.__segments.ack(position)
+            count_frames += len(frames)
+
+    def __encoded_frames(self, file_name, origin=None):
+        """Takes the frames of a file from the payload cache or reads them.
+        @param origin: if set, frames are first wrapped in an Origin Frame
+        @return cache key (None without cache) and list of base64 encoded frames
+        """
+        if self.payload_cache is None:
+            return None, self.__read_frames(file_name, origin)
+        key = payload_key(file_name, origin)
+        frames = self.payload_cache.get(key)
+        if frames is None:
+            frames = self.__read_frames(file_name, origin)
+        return key, frames
+
+    def __cache_failed(self, entries):
+        """Keeps the frames of files that failed to send for their retry.
+        @param entries: list of (cache key, frames) tuples
+        """
+        if self.payload_cache is not None:
+            for key, frames in entries:
+                self.payload_cache.put(key, frames)
+
+    def __read_frames(self, file_name, origin=None):
+        """Reads one file and wraps its frames in Timestamp or Delayed Frames.
+        @param origin: if set, frames are first wrapped in an Origin Frame
+        @return list of base64 encoded frames
+        """
+        with QueueFileReader(file_name) as reader:
+            return self.__wrap_frames(reader, origin)
+
+    def __wrap_frames(self, records, origin=None):
+        """Wraps frames in Timestamp or Delayed Frames.
+        @param records: iterable of (timestamp, frame) tuples
+        @param origin: if set, frames are first wrapped in an Origin Frame
+        @return list of base64 encoded frames
+        """
         frames=[]
-        timestamp = current_file.read(8)
-        while timestamp:  # until end of file
-            timestamp = unpack('<d', timestamp)[0]
-            frame_length = unpack('<h', current_file.read(2))[0]
-            frame = current_file.read(frame_length)
+        if origin:  # header of an Origin Frame, see OriginFrame.create
+            origin = origin[0:255]
+            origin_header = pack('<BB', 0xb, len(origin)) + origin
+        for timestamp, frame in records:
             if frame:
+                if origin:
+                    frame = origin_header + str(frame)
                 if self.absolute_time:  # Timestamp Frame
                     # millisecond resolution from 1970-01-01
                     wrapper_frame = BayEOSFrame.factory(0xc)
 
                 else:  # Delayed Frame
                     wrapper_frame = BayEOSFrame.factory(0x7)
-                wrapper_frame.create(frame, timestamp)
+                wrapper_frame.create(str(frame), timestamp)
                 frames.append(base64.b64encode(wrapper_frame.frame))
-            timestamp = current_file.read(8)
-        current_file.close()
-        backup_file_name = file_name.replace('.rd', '.bak')
-        if self.backup_path:
-            backup_file_name.replace(self.path, self.backup_path)
-        if len(frames)==0:
-            move(file_name, backup_file_name)
-            logging.warning('No frames in file. Move to ' + backup_file_name)
-            return 0
-        
-        data['bayeosframes[]']=frames
-        headers={'user-agent': 'BayEOS-Python-Gateway-Client/0.3.9'}
+        return frames
+
+    def __post(self, frames):
+        """Posts base64 encoded frames to the gateway.
+        @return True on success
+        """
+        data={'sender': self.name, 'bayeosframes[]': frames}
+        headers={}
+        if self.compression:
+            data = CONTENT_ENCODINGS[self.compression](urlencode(data, True))
+            headers['content-type'] = 'application/x-www-form-urlencoded'
+            headers['content-encoding'] = self.compression
+        start = time()
         try:
-            r=requests.post(self.url,data=data,auth=(self.user, self.password),headers=headers, timeout=10)
+            r=self.session.post(self.url,data=data,headers=headers,timeout=10)
 #            r.raise_for_status()
         except requests.exceptions.RequestException as e:  
-            logging.warning('sender __post error:'+e)
-            return 0
+            self.metrics.inc('post_errors')
+            logging.warning('sender __post error:'+str(e))
+            self.__record_failure()
+            return False
+        self.metrics.observe('post_seconds', time() - start)
+        self.metrics.inc('responses', labels=(('status', str(r.status_code)),))
+        retries = getattr(getattr(r.raw, 'retries', None), 'history', None)
+        if retries:
+            self.metrics.inc('retries', len(retries))
         
         if r.status_code==200: # all fine!
+            self.metrics.inc('frames', len(frames))
+            self.metrics.inc('bytes', len(data) if self.compression else sum(len(frame) for frame in frames))
+            self.failures = 0
+            return True
+        
+        logging.warning('sender __post error code: '+str(r.status_code))
+        if gateway_unavailable(r.status_code):
+            retry_after = r.headers.get('retry-after', '')
+            self.__record_failure(int(retry_after) if retry_after.isdigit() else None)
+        
+        return False
+
+    def __backup_file_name(self, file_name):
+        """@return name of the .bak file for a sent file"""
+        backup_file_name = file_name.replace('.rd', '.bak')
+        if self.backup_path:
+            backup_file_name.replace(self.path, self.backup_path)
+        return backup_file_name
+
+    def __move_to_backup(self, file_name):
+        """Moves a file without frames to its .bak name."""
+        backup_file_name = self.__backup_file_name(file_name)
+        move(file_name, backup_file_name)
+        self.metrics.inc('backup_moves')
+        logging.warning('No frames in file. Move to ' + backup_file_name)
+
+    def __archive(self, file_name, key=None):
+        """Deletes a sent file or renames it to *.bak ending.
+        @param key: payload cache key of the file, its entry is dropped
+        """
+        if self.payload_cache is not None:
+            self.payload_cache.discard(key)
+        try:
             if self.remove:
                 os.remove(file_name)
             else:
-                move(file_name, backup_file_name)
-            return len(frames)
-        
-        logging.warning('sender __post error code: '+r.status_code)
-        
-        return 0
+                move(file_name, self.__backup_file_name(file_name))
+        except (IOError, OSError):
+            if os.path.exists(file_name):
+                raise
+            logging.warning('File ' + file_name + ' was taken by a quota while it was sent.')
  
     def run(self, sleep_sec=DEFAULTS['sender_sleep_time']):
         """Tries to send frames within a certain interval.
@@ -367,7 +1388,51 @@ class BayEOSSender(object):
                 logging.warning('Exception:' + str(err) + '\n') 
             except:
                 logging.warning('Unknown exception in run()\n')
+            self.wait(sleep_sec)
+
+    def wait(self, sleep_sec=DEFAULTS['sender_sleep_time']):
+        """Sleeps until the writer finished a file or sleep_sec passed.
+        Writers in the same process wake the sender directly, writers in
+        other processes through inotify where available. A sender with devices
+        waits for the files of its devices.
+        While the circuit is open, sleeps until the next probe instead.
+        @param sleep_sec: maximum sleep time
+        """
+        delay = self.circuit_delay()
+        if delay:
+            sleep(max(delay, sleep_sec))
+            return
+        if not self.watch:
             sleep(sleep_sec)
+            return
+        if not self.__watcher:  # created lazily, as start() may fork
+            if self.devices:
+                self.__watcher = self.__devices_watcher()
+            elif self.queue_index:
+                self.__watcher = self.__get_index().watcher
+            elif self.shared_watcher:
+                self.shared_watcher.watch(self.path)
+                self.__watcher = self.shared_watcher
+            else:
+                self.__watcher = QueueWatcher(self.path, self.inotify)
+        self.__watcher.wait(sleep_sec)
+
+    def __devices_watcher(self):
+        """@return QueueWatcher of all device directories"""
+        if self.queue_index:  # the indexes watch their directories
+            for origin in self.devices:
+                self.__device_index(origin)
+        else:
+            self.__device_watcher = QueueWatcher(None, self.inotify)
+            for origin in self.devices:
+                self.__device_watcher.watch(self.devices[origin])
+        return self.__device_watcher
+
+    def __get_index(self):
+        """@return QueueIndex of path, created on first use"""
+        if not self.__index:
+            self.__index = QueueIndex(self.path, self.inotify, self.shared_watcher)
+        return self.__index
     
     def run_thread(self,sleep_sec=DEFAULTS['sender_sleep_time']):
         """Starts a run thread. When this thread terminates it starts a new run thread
@@ -422,6 +1487,8 @@ class BayEOSGatewayClient(object):
         options['sender'] = {}
         for each_name in names:
             options['sender'][each_name] = prefix + each_name
+        # name of a shared sender, frames are wrapped in Origin Frames of the device senders
+        self.shared_name = prefix[:-1] if prefix else options['sender'][names[0]]
 
         # Set missing options on default values
         for each_default in DEFAULTS.items():
@@ -469,29 +1536,120 @@ class BayEOSGatewayClient(object):
     def __start_writer(self, path):
         """Instantiates a BayEOSWriter object and starts an endless loop for data acquisition."""
         self.init_writer()
-        self.writer = BayEOSWriter(path, self.__get_option('max_chunk'),
-                                    self.__get_option('max_time'))
+        self.writer = self.__create_writer(path)
         print 'Started writer for ' + self.name + ' with pid ' + str(os.getpid())
         self.writer.save_msg('Started writer for ' + self.name)
+        scheduler = TickScheduler(self.__get_option('writer_sleep_time'),
+                                  self.__phase(self.__get_option('writer_sleep_time')), self.name,
+                                  immediate=True)
         while True:
+            scheduler.wait()
             data = self.read_data()
             if data:
                 self.save_data(data)
-            sleep(self.__get_option('writer_sleep_time'))
+            scheduler.done()
+
+    def __phase(self, period):
+        """@return offset of the ticks of the current device within period,
+        devices are spread evenly if the option spread_ticks is set
+        """
+        if not self.options['spread_ticks']:
+            return 0
+        return period * self.names.index(self.name) / float(len(self.names))
+
+    def __create_writer(self, path):
+        """@return BayEOSWriter for the current device configured by options"""
+        return BayEOSWriter(path, self.__get_option('max_chunk'),
+                            self.__get_option('max_time'),
+                            buffer_frames=self.__get_option('buffer_frames'),
+                            buffer_bytes=self.__get_option('buffer_bytes'),
+                            buffer_time=self.__get_option('buffer_time'),
+                            durability=self.__get_option('durability'),
+                            store=self.__get_option('store'),
+                            segment_size=self.__get_option('segment_size'),
+                            max_queue_bytes=self.__get_option('max_queue_bytes'),
+                            eviction=self.__get_option('eviction'),
+                            thin_factor=self.__get_option('thin_factor'),
+                            origin_priorities=self.__get_option('origin_priorities'),
+                            crc=self.__get_option('crc'))
 
     def __start_sender(self, path):
         """Instantiates a BayEOSSender object and starts an endless loop for frame sending."""
-        self.sender = BayEOSSender(path,
-                                   self.__get_option('sender'),
-                                   self.__get_option('url'),
-                                   self.__get_option('bayeosgateway_password'),
-                                   self.__get_option('bayeosgateway_user'),
-                                   self.__get_option('absolute_time'),
-                                   self.__get_option('remove'))
+        self.sender = self.__create_sender(path)
         print 'Started sender for ' + self.name + ' with pid ' + str(os.getpid())
         while True:
-            self.sender.send()
-            sleep(self.__get_option('sender_sleep_time'))
+            try:
+                self.sender.send()
+            except Exception as err:
+                logging.warning('Exception:' + str(err))
+            self.sender.wait(self.__get_option('sender_sleep_time'))
+
+    def __create_sender(self, path, inotify=None, devices=None):
+        """@param inotify: overrides the inotify option if not None
+        @param devices: dictionary origin : path of devices for a shared sender
+        @return BayEOSSender for the current device configured by options
+        """
+        if inotify is None:
+            inotify = self.__get_option('inotify')
+        name = self.shared_name if devices else self.__get_option('sender')
+        archive_path = self.__get_option('archive_path')
+        if archive_path:  # one archive per device
+            archive_path = os.path.join(archive_path, os.path.basename(path))
+        backup_path = self.__get_option('backup_path')
+        if backup_path:  # one backup directory per device
+            backup_path = os.path.join(backup_path, os.path.basename(path))
+        payload_spill_path = self.__get_option('payload_spill_path')
+        if payload_spill_path:
+            payload_spill_path = os.path.join(payload_spill_path, os.path.basename(path))
+        return BayEOSSender(path,
+                            name,
+                            self.__get_option('url'),
+                            self.__get_option('bayeosgateway_password'),
+                            self.__get_option('bayeosgateway_user'),
+                            self.__get_option('absolute_time'),
+                            self.__get_option('remove'),
+                            backup_path=backup_path,
+                            pool_size=self.__get_option('pool_size'),
+                            retries=self.__get_option('retries'),
+                            backoff_factor=self.__get_option('backoff_factor'),
+                            batch_bytes=self.__get_option('batch_bytes'),
+                            batch_frames=self.__get_option('batch_frames'),
+                            workers=self.__get_option('workers'),
+                            ordering=self.__get_option('ordering'),
+                            compression=self.__get_option('compression'),
+                            watch=self.__get_option('watch'),
+                            queue_index=self.__get_option('queue_index'),
+                            inotify=inotify,
+                            store=self.__get_option('store'),
+                            segment_size=self.__get_option('segment_size'),
+                            max_backup_bytes=self.__get_option('max_backup_bytes'),
+                            eviction=self.__get_option('eviction'),
+                            thin_factor=self.__get_option('thin_factor'),
+                            origin_priorities=self.__get_option('origin_priorities'),
+                            archive_path=archive_path,
+                            archive_partition=self.__get_option('archive_partition'),
+                            archive_interval=self.__get_option('archive_interval'),
+                            devices=devices,
+                            breaker_threshold=self.__get_option('breaker_threshold'),
+                            breaker_backoff=self.__get_option('breaker_backoff'),
+                            breaker_max_backoff=self.__get_option('breaker_max_backoff'),
+                            probe_timeout=self.__get_option('probe_timeout'),
+                            payload_cache_bytes=self.__get_option('payload_cache_bytes'),
+                            payload_spill_path=payload_spill_path)
+
+    def __start_shared_sender(self, devices):
+        """Starts an endless loop sending the queue directories of all devices.
+        @param devices: dictionary origin : path
+        """
+        self.name = self.names[0]  # options of the first device apply
+        self.sender = self.__create_sender(self.__init_folder('shared-sender'), devices=devices)
+        print 'Started shared sender for ' + str(len(devices)) + ' devices with pid ' + str(os.getpid())
+        while True:
+            try:
+                self.sender.send()
+            except Exception as err:
+                logging.warning('Exception:' + str(err))
+            self.sender.wait(self.__get_option('sender_sleep_time'))
 
     def __start_sender_writer_pair(self, path, thread=True):
         """Creates a sender-writer pair.
@@ -508,8 +1666,18 @@ class BayEOSGatewayClient(object):
         Creates an own process for an instance of BayEOSWriter and BayEOSSender per device name.
         @param pair: if False writer and sender started in two processes, other parameters will be ignored
         @param thread: if True sender runs in a thread
+        With the option shared_sender one process sends the data of all devices.
         """
         print 'Parent pid is ' + str(os.getpid())
+        if self.options['shared_sender']:
+            devices = {}
+            for each_name in self.names:
+                self.name = each_name
+                path = self.__init_folder(each_name)
+                devices[self.__get_option('sender')] = path
+                Process(target=self.__start_writer, args=(path,)).start()
+            Process(target=self.__start_shared_sender, args=(devices,)).start()
+            return
         for each_name in self.names:
             self.name = each_name  # will be forked and then overwritten
             path = self.__init_folder(each_name)
@@ -519,6 +1687,92 @@ class BayEOSGatewayClient(object):
             else:
                 Process(target=self.__start_sender_writer_pair, args=(path, thread)).start()
 
+    def run_hub(self, processes=None, workers=None):
+        """Runs all devices in a few processes instead of one or two processes per device.
+        Each hub process calls read_data() and save_data() of its devices in turn and
+        sends from a shared pool of worker threads. self.name and self.writer are set to
+        the device whose data is read. With the option shared_sender each hub process
+        sends all its devices through one sender.
+        @param processes: number of hub processes, devices are distributed round-robin,
+        default option hub_processes
+        @param workers: number of sender threads per hub process, default option hub_workers
+        """
+        if processes is None:
+            processes = self.options['hub_processes']
+        if workers is None:
+            workers = self.options['hub_workers']
+        print 'Parent pid is ' + str(os.getpid())
+        processes = max(1, min(processes, len(self.names)))
+        groups = [self.names[i::processes] for i in range(processes)]
+        for names in groups[1:]:
+            Process(target=self.__run_hub, args=(names, workers)).start()
+        self.__run_hub(groups[0], workers)
+
+    def __run_hub(self, names, workers):
+        """Schedules reading and sending of several devices in one process.
+        @param names: device names of this hub
+        @param workers: number of sender threads
+        """
+        devices = []
+        schedule = []  # heap of (monotonic due time, device index, 'read' or 'send')
+        shared = self.options['shared_sender']
+        shared_devices = {}
+        for index, each_name in enumerate(names):
+            self.name = each_name
+            path = self.__init_folder(each_name)
+            self.init_writer()
+            period = self.__get_option('writer_sleep_time')
+            device = {'name' : each_name,
+                      'writer' : self.__create_writer(path),
+                      'reads' : TickScheduler(period, self.__phase(period), each_name),
+                      'sending' : None}
+            device['writer'].save_msg('Started writer for ' + each_name)
+            devices.append(device)
+            heappush(schedule, (device['reads'].next_tick, index, 'read'))
+            if shared:
+                shared_devices[self.__get_option('sender')] = path
+                continue
+            # writers of a hub notify their senders in-process
+            device['sender'] = self.__create_sender(path, inotify=False)
+            period = self.__get_option('sender_sleep_time')
+            device['sends'] = TickScheduler(period, self.__phase(period))
+            heappush(schedule, (device['sends'].next_tick, index, 'send'))
+        if shared:  # pseudo device without reads
+            self.name = names[0]
+            devices.append({'name' : self.shared_name,
+                            'sender' : self.__create_sender(self.__init_folder('shared-sender'),
+                                                            False, shared_devices),
+                            'sends' : TickScheduler(self.__get_option('sender_sleep_time')),
+                            'sending' : None})
+            heappush(schedule, (devices[-1]['sends'].next_tick, len(names), 'send'))
+        print 'Started hub for ' + str(len(names)) + ' devices with pid ' + str(os.getpid())
+        pool = ThreadPool(workers)
+        while True:
+            due, index, task = heappop(schedule)
+            delay = due - monotonic()
+            if delay > 0:
+                sleep(delay)
+            device = devices[index]
+            if task == 'read':
+                scheduler = device['reads']
+                scheduler.tick()
+                self.name = device['name']
+                self.writer = device['writer']
+                try:
+                    data = self.read_data()
+                    if data:
+                        self.save_data(data)
+                except Exception as err:
+                    logging.warning('Hub read error on ' + device['name'] + ': ' + str(err))
+                scheduler.done()
+            else:
+                scheduler = device['sends']
+                scheduler.tick()
+                # a device is not sent again while its last send is still running
+                if device['sending'] is None or device['sending'].ready():
+                    device['sending'] = pool.apply_async(device['sender'].send)
+            heappush(schedule, (scheduler.next_tick, index, task))
+
     @abstractmethod
     def init_writer(self):
         """Method called by run(). Can be overwritten by implementation."""
@@ -0,0 +1,261 @@
+"""Counters, gauges and histograms of BayEOSWriter and BayEOSSender.
+
+Every writer and sender owns a Metrics instance, registered in REGISTRY.
+The registry can be read in-process with snapshot() or exported in the
+Prometheus text format to a file or through a small HTTP endpoint.
+"""
+
+import os
+import logging
+import threading
+import weakref
+import BaseHTTPServer
+import SocketServer
+from bisect import bisect_left
+from glob import glob
+from time import sleep
+from bayeosqueue import SEGMENT_NAME, SegmentStore, queue_file_time
+
+# upper bounds of the POST latency histogram in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def queue_depth(path):
+    """Measures the backlog of a queue directory.
+    Of a segment store only the unread records behind the cursor are counted.
+    @return dictionary with number of 'files', their size in 'bytes' and the
+    'oldest_timestamp' of the oldest .rd file or unread record (None without)
+    """
+    files = glob(os.path.join(path, '*.rd'))
+    oldest = min([queue_file_time(each_file) for each_file in files]) if files else None
+    size = 0
+    for each_file in files:
+        try:
+            size += os.path.getsize(each_file)
+        except OSError:  # sent in the meantime
+            pass
+    count = len(files)
+    if glob(os.path.join(path, SEGMENT_NAME.replace('%08d', '*'))):
+        segments, segment_bytes, segment_oldest = SegmentStore(path).backlog()
+        count += segments
+        size += segment_bytes
+        if segment_oldest is not None and (oldest is None or segment_oldest < oldest):
+            oldest = segment_oldest
+    return {'files' : count, 'bytes' : size, 'oldest_timestamp' : oldest}
+
+class Histogram(object):
+    """Histogram with fixed bucket bounds."""
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """@return dictionary with cumulative bucket counts, sum and count"""
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {'buckets' : buckets, 'sum' : self.sum, 'count' : self.count}
+
+class Metrics(object):
+    """Metrics of one writer or sender.
+    Counters and histograms are updated on the hot path, gauges and
+    counter functions are evaluated only when a snapshot is taken.
+    """
+
+    def __init__(self, component, labels=None, registry=None):
+        """Creates a Metrics instance and registers it.
+        @param component: name prefix, e.g. 'writer' or 'sender'
+        @param labels: dictionary of labels added to every metric, e.g. {'path' : path}
+        @param registry: MetricsRegistry, default REGISTRY
+        """
+        self.component = component
+        self.labels = labels or {}
+        self.__counters = {}
+        self.__histograms = {}
+        self.__gauges = {}
+        self.__counter_functions = {}
+        self.__lock = threading.Lock()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def inc(self, name, value=1, labels=()):
+        """Increases a counter.
+        @param labels: tuple of (label, value) pairs
+        """
+        key = (name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name, value, bounds=LATENCY_BUCKETS):
+        """Adds a value to a histogram."""
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+            if histogram is None:
+                histogram = self.__histograms[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    def counter(self, name, function):
+        """Registers a counter kept by its owner, e.g. as an integer attribute,
+        which avoids the lock of inc() on single threaded hot paths.
+        @param function: called without arguments on snapshot(), returns the count
+        """
+        self.__counter_functions[name] = function
+
+    def gauge(self, name, function):
+        """Registers a gauge.
+        @param function: called without arguments on snapshot(), returns a number, None
+        or a dictionary of several values, named name_<key>
+        """
+        self.__gauges[name] = function
+
+    def snapshot(self):
+        """@return dictionary with 'counters', 'gauges' and 'histograms', keyed by
+        metric name or (name, labels) for labeled counters
+        """
+        with self.__lock:
+            counters = dict(((name, labels) if labels else name, value)
+                            for (name, labels), value in self.__counters.items())
+            histograms = dict((name, histogram.snapshot())
+                              for name, histogram in self.__histograms.items())
+        for name, function in self.__counter_functions.items():
+            counters[name] = function()
+        gauges = {}
+        for name, function in self.__gauges.items():
+            try:
+                value = function()
+            except Exception as err:
+                logging.warning('Could not evaluate gauge ' + name + ': ' + str(err))
+                continue
+            if isinstance(value, dict):
+                for key, each_value in value.items():
+                    gauges[name + '_' + key] = each_value
+            else:
+                gauges[name] = value
+        return {'component' : self.component, 'labels' : dict(self.labels),
+                'counters' : counters, 'gauges' : gauges, 'histograms' : histograms}
+
+class MetricsRegistry(object):
+    """Collects the Metrics of all live writers and senders."""
+
+    def __init__(self):
+        self.__metrics = weakref.WeakSet()
+        self.__lock = threading.Lock()
+
+    def register(self, metrics):
+        with self.__lock:
+            self.__metrics.add(metrics)
+
+    def snapshot(self):
+        """@return list of snapshots of all registered Metrics"""
+        with self.__lock:
+            metrics = list(self.__metrics)
+        return [each.snapshot() for each in metrics]
+
+    def prometheus(self, prefix='bayeos_'):
+        """Renders all metrics in the Prometheus text exposition format.
+        @return string
+        """
+        samples = {}
+        for snapshot in self.snapshot():
+            base = prefix + snapshot['component'] + '_'
+            labels = sorted(snapshot['labels'].items())
+            for key, value in snapshot['counters'].items():
+                name, extra = key if isinstance(key, tuple) else (key, ())
+                samples.setdefault((base + name + '_total', 'counter'), []).append(
+                    ('', labels + list(extra), value))
+            for name, value in snapshot['gauges'].items():
+                if value is not None:
+                    samples.setdefault((base + name, 'gauge'), []).append(('', labels, value))
+            for name, histogram in snapshot['histograms'].items():
+                lines = samples.setdefault((base + name, 'histogram'), [])
+                for bound, count in histogram['buckets']:
+                    lines.append(('_bucket', labels + [('le', _format_value(bound))], count))
+                lines.append(('_sum', labels, histogram['sum']))
+                lines.append(('_count', labels, histogram['count']))
+        output = []
+        for (name, kind), lines in sorted(samples.items()):
+            output.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in lines:
+                output.append(name + suffix + _format_labels(labels) + ' ' + _format_value(value))
+        return '\n'.join(output) + '\n'
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+REGISTRY = MetricsRegistry()
+
+class PrometheusFileSink(object):
+    """Writes the registry to a file, e.g. for the node_exporter textfile collector."""
+
+    def __init__(self, file_name, registry=REGISTRY, interval=15):
+        """@param interval: seconds between two writes when started"""
+        self.file_name = os.path.abspath(file_name)
+        self.registry = registry
+        self.interval = interval
+
+    def write(self):
+        """Replaces the file atomically with the current metrics."""
+        tmp_name = self.file_name + '.tmp'
+        try:
+            with open(tmp_name, 'w') as output:
+                output.write(self.registry.prometheus())
+            os.rename(tmp_name, self.file_name)
+        except (IOError, OSError) as err:
+            logging.warning('Could not write metrics: ' + str(err))
+
+    def run(self):
+        while True:
+            self.write()
+            sleep(self.interval)
+
+    def start(self):
+        """Writes the file periodically in a daemon thread."""
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the registry of a PrometheusHTTPServer on GET."""
+
+    def do_GET(self):
+        body = self.server.registry.prometheus()
+        self.send_response(200)
+        self.send_header('content-type', 'text/plain; version=0.0.4')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class PrometheusHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP endpoint for Prometheus scrapes."""
+    daemon_threads = True
+
+    def __init__(self, host='', port=9464, registry=REGISTRY):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), MetricsRequestHandler)
+        self.registry = registry
+
+    def start(self):
+        """Serves scrapes in a daemon thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logging.info('Serving metrics on port ' + str(self.server_address[1]))
@@ -0,0 +1,894 @@
+"""Access to the queue files written by BayEOSWriter.
+
+Every record of a queue file consists of an 8 byte timestamp (double),
+a 2 byte frame length (short) and the binary coded BayEOS Frame.
+Files starting with CRC_MAGIC carry a CRC32 of header and frame behind
+every record.
+"""
+
+import os
+import zlib
+import tempfile
+import logging
+import ctypes
+import ctypes.util
+from mmap import mmap, ACCESS_READ
+from bisect import bisect_right
+from glob import glob
+from select import select
+from struct import Struct
+from threading import Event, Lock
+from time import time
+try:
+    import fcntl
+except ImportError:  # not a POSIX platform
+    fcntl = None
+
+RECORD_HEADER = Struct('<dh')
+RECORD_CRC = Struct('<I')
+CRC_MAGIC = RECORD_HEADER.pack(0, 4) + 'CRC1'
+
+def pack_record(timestamp, frame, crc=False):
+    """Creates a queue record.
+    @param crc: if True a CRC32 of header and frame is appended
+    @return binary coded record
+    """
+    record = RECORD_HEADER.pack(timestamp, len(frame)) + frame
+    if crc:
+        record += RECORD_CRC.pack(zlib.crc32(record) & 0xffffffff)
+    return record
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init
+    if fcntl is None:
+        raise OSError('inotify descriptors cannot be made non-blocking')
+except (OSError, AttributeError, TypeError):  # no inotify on this platform
+    _libc = None
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+# renamed by a writer, or copied, linked or restored by hand
+QUEUE_FILE_EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+IN_Q_OVERFLOW = 0x4000
+INOTIFY_EVENT = Struct('iIII')
+
+_queue_events = {}
+_queue_indexes = {}
+_queue_watchers = {}  # path : QueueWatchers with inotify, woken through their pipe
+_queue_events_lock = Lock()
+
+def queue_event(path):
+    """Returns the in-process Event that is set when a file in path is ready for post.
+    @param path: queue directory
+    @return threading.Event
+    """
+    path = os.path.abspath(path)
+    with _queue_events_lock:
+        if path not in _queue_events:
+            _queue_events[path] = Event()
+        return _queue_events[path]
+
+def notify_queue(path, file_name=None):
+    """Wakes up senders waiting for path in this process.
+    @param file_name: if given, the file is added to the QueueIndex instances of path
+    """
+    path = os.path.abspath(path)
+    with _queue_events_lock:
+        indexes = list(_queue_indexes.get(path, ()))
+        watchers = list(_queue_watchers.get(path, ()))
+    if file_name:
+        for index in indexes:
+            index.add(file_name)
+    queue_event(path).set()
+    # a watcher blocked on its inotify descriptor does not see the Event,
+    # and segment appends create no inotify event at all
+    for watcher in watchers:
+        watcher.wake()
+
+def queue_file_time(file_name):
+    """Returns the time a queue file was started, taken from its name
+    (<seconds>-<microseconds>-<sequence>-<random>.rd, older writers leave out the
+    sequence) or from its modification time.
+    """
+    parts = os.path.basename(file_name).split('-')
+    try:
+        return float(parts[0] + '.' + parts[1])
+    except (ValueError, IndexError):
+        try:
+            return os.path.getmtime(file_name)
+        except OSError:
+            return 0
+
+def queue_file_key(file_name):
+    """Sort key of queue files, oldest first. Files started at the same time are
+    ordered by the sequence number of their writer.
+    @return tuple of start time and sequence number (0 for names without one)
+    """
+    parts = os.path.basename(file_name).split('-')
+    if len(parts) > 3 and parts[2].isdigit():
+        return queue_file_time(file_name), int(parts[2])
+    return queue_file_time(file_name), 0
+
+class QueueFileReader(object):
+    """Reads the records of a queue file through a memory map."""
+
+    def __init__(self, file_name):
+        """Opens and maps a queue file.
+        @param file_name: path of a .act, .rd or .bak file
+        """
+        self.file_name = file_name
+        self.truncated = 0
+        self.valid_size = 0
+        self.__file = open(file_name, 'rb')
+        self.size = os.fstat(self.__file.fileno()).st_size
+        if self.size:
+            self.__data = mmap(self.__file.fileno(), 0, access=ACCESS_READ)
+        else:  # empty files cannot be mapped
+            self.__data = ''
+        self.crc = self.__data[:len(CRC_MAGIC)] == CRC_MAGIC
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def records(self):
+        """Yields the records of the file.
+        Frames are read-only buffers into the mapped file and are only valid until close().
+        An incomplete trailing record is skipped, its size is stored in truncated.
+        In files with CRC reading stops at the first record with a wrong CRC.
+        @return generator of (timestamp, frame) tuples
+        """
+        data = self.__data
+        size = self.size
+        header_size = RECORD_HEADER.size
+        crc_size = RECORD_CRC.size if self.crc else 0
+        pos = len(CRC_MAGIC) if self.crc else 0
+        while pos + header_size <= size:
+            timestamp, frame_length = RECORD_HEADER.unpack_from(data, pos)
+            end = pos + header_size + frame_length
+            if frame_length < 0 or end + crc_size > size:
+                break
+            if crc_size and zlib.crc32(buffer(data, pos, end - pos)) & 0xffffffff != \
+                    RECORD_CRC.unpack_from(data, end)[0]:
+                break
+            yield timestamp, buffer(data, pos + header_size, frame_length)
+            pos = end + crc_size
+        self.valid_size = pos
+        self.truncated = size - pos
+        if self.truncated:
+            logging.warning('Truncated record in ' + self.file_name + ': ' +
+                            str(self.truncated) + ' bytes at offset ' + str(pos))
+
+    def close(self):
+        """Unmaps and closes the file."""
+        if self.size:
+            self.__data.close()
+        self.__file.close()
+
+def recover_queue_file(file_name):
+    """Truncates a queue file behind its last valid record.
+    @return number of valid records and number of bytes cut off
+    """
+    with QueueFileReader(file_name) as reader:
+        records = sum(1 for record in reader)
+        valid_size, lost = reader.valid_size, reader.truncated
+    if lost:
+        with open(file_name, 'r+b') as queue_file:
+            queue_file.truncate(valid_size)
+    return records, lost
+
+def recover_queue(path):
+    """Repairs the .act files a crashed writer left behind and marks them ready for post.
+    Files without valid records are removed.
+    @param path: queue directory
+    @return list of (file name, valid records, bytes cut off) tuples
+    """
+    report = []
+    for each_file in glob(os.path.join(path, '*.act')):
+        try:
+            records, lost = recover_queue_file(each_file)
+            if records:
+                os.rename(each_file, each_file[:-len('.act')] + '.rd')
+            else:
+                os.remove(each_file)
+        except (IOError, OSError) as err:
+            logging.warning('OSError: ' + str(err))
+            continue
+        if lost:
+            logging.warning('Recovered ' + each_file + ': kept ' + str(records) +
+                            ' records, cut off ' + str(lost) + ' bytes.')
+        report.append((each_file, records, lost))
+    return report
+
+class QueueWatcher(object):
+    """Waits for new .rd files in a queue directory.
+    Uses inotify where available, so writers in other processes are noticed,
+    and falls back to the in-process queue_event() otherwise.
+    Further directories can be watched on the same inotify instance, which
+    are limited per user.
+    """
+
+    def __init__(self, path, inotify=True, callback=None):
+        """Starts watching a directory.
+        @param path: queue directory, None to only watch directories added by watch()
+        @param inotify: if False only writers of the same process are noticed
+        @param callback: called with the name of every new .rd file seen by inotify
+        """
+        self.path = os.path.abspath(path) if path is not None else None
+        self.event = queue_event(self.path) if path is not None else Event()
+        self.callback = callback
+        self.overflows = 0
+        self.fd = None
+        self.__watches = {}  # watch descriptor : (directory, callback)
+        self.__wake_fds = None
+        if inotify and _libc:
+            fd = _libc.inotify_init()
+            if fd < 0:
+                logging.warning('inotify failed: ' + os.strerror(ctypes.get_errno()))
+                return
+            self.__wake_fds = os.pipe()  # written by notify_queue() of this process
+            for each_fd in (fd,) + self.__wake_fds:
+                fcntl.fcntl(each_fd, fcntl.F_SETFL,
+                            fcntl.fcntl(each_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self.fd = fd
+            if path is not None and not self.watch(self.path, callback):
+                self.close()
+
+    def watch(self, path, callback=None):
+        """Watches a further directory on the same inotify instance.
+        @param callback: called with the name of every new .rd file in path
+        @return True if inotify watches path
+        """
+        if self.fd is None:
+            return False
+        path = os.path.abspath(path)
+        wd = _libc.inotify_add_watch(self.fd, path, QUEUE_FILE_EVENTS)
+        if wd < 0:
+            logging.warning('inotify failed on ' + path + ': ' + os.strerror(ctypes.get_errno()))
+            return False
+        self.__watches[wd] = (path, callback)
+        with _queue_events_lock:
+            watchers = _queue_watchers.setdefault(path, [])
+            if self not in watchers:
+                watchers.append(self)
+        return True
+
+    def wake(self):
+        """Ends a wait() of another thread, called by notify_queue()."""
+        try:
+            os.write(self.__wake_fds[1], 'x')
+        except (OSError, TypeError):  # pipe full or watcher closed
+            pass
+
+    def wait(self, timeout):
+        """Blocks until a new .rd file appears or timeout seconds passed.
+        @return True if a new file was noticed
+        """
+        if self.fd is None:
+            ready = self.event.wait(timeout)
+            self.event.clear()
+            return bool(ready)
+        deadline = time() + timeout
+        while True:  # events of other files, e.g. a new .act file, do not end the wait
+            ready = select([self.fd, self.__wake_fds[0]], [], [], max(0, deadline - time()))[0]
+            if self.__wake_fds[0] in ready:
+                self.event.clear()
+                try:
+                    while os.read(self.__wake_fds[0], 4096):
+                        pass
+                except OSError:
+                    pass
+                return True
+            if not ready:
+                return False
+            if self.__read_events():
+                return True
+
+    def __read_events(self):
+        """Drains the inotify descriptor.
+        @return True if a .rd file was moved, copied or linked into a watched directory
+        """
+        found = False
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            return False
+        pos = 0
+        while pos + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                self.overflows += 1
+                found = True
+            elif name.endswith('.rd'):
+                found = True
+                path, callback = self.__watches.get(wd, (self.path, self.callback))
+                if callback:
+                    callback(os.path.join(path, name))
+        return found
+
+    def poll(self):
+        """Handles pending inotify events without blocking.
+        @return True if a new file was noticed
+        """
+        found = False
+        while self.fd is not None and select([self.fd], [], [], 0)[0]:
+            found = self.__read_events() or found
+        return found
+
+    def close(self):
+        """Stops watching."""
+        with _queue_events_lock:
+            for path, callback in self.__watches.values():
+                if self in _queue_watchers.get(path, ()):
+                    _queue_watchers[path].remove(self)
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.__wake_fds:
+            for each_fd in self.__wake_fds:
+                os.close(each_fd)
+            self.__wake_fds = None
+
+class QueueIndex(object):
+    """Index of the .rd files of a queue directory, oldest first.
+    The directory is scanned once. Afterwards files are added when a writer of
+    the same process publishes them or when inotify reports them, and the
+    directory is scanned again every rescan_interval seconds in case an event
+    was missed. If inotify fails the directory is scanned again on every call
+    of files().
+    """
+
+    def __init__(self, path, inotify=True, watcher=None, rescan_interval=300):
+        """Scans a queue directory and starts watching it.
+        @param path: queue directory
+        @param inotify: if False only writers of the same process add files after the scan
+        @param watcher: QueueWatcher shared by several indexes, which then use a single
+        inotify instance, default a QueueWatcher of this index
+        @param rescan_interval: seconds between full scans of the directory, None for never
+        """
+        self.path = os.path.abspath(path)
+        self.inotify = inotify
+        self.rescan_interval = rescan_interval
+        self.__scanned = 0
+        self.__lock = Lock()
+        self.__keys = []
+        self.__files = []
+        self.__head = 0
+        self.__known = set()
+        self.__overflows = 0
+        self.__shared_watcher = watcher is not None
+        if watcher is None:
+            self.watcher = QueueWatcher(self.path, inotify, callback=self.add)
+            self.__watched = self.watcher.fd is not None
+        else:
+            self.watcher = watcher
+            self.__watched = inotify and watcher.watch(self.path, self.add)
+        with _queue_events_lock:
+            _queue_indexes.setdefault(self.path, []).append(self)
+        self.rebuild()
+
+    def rebuild(self):
+        """Scans the directory and replaces the index."""
+        overflows = self.watcher.overflows
+        self.__scanned = time()
+        files = sorted((queue_file_key(each_file), each_file)
+                       for each_file in glob(os.path.join(self.path, '*.rd')))
+        with self.__lock:
+            self.__keys = [key for key, each_file in files]
+            self.__files = [each_file for key, each_file in files]
+            self.__head = 0
+            self.__known = set(self.__files)
+        self.__overflows = overflows
+
+    def add(self, file_name):
+        """Adds a file. Files arriving in time order are appended in O(1)."""
+        key = queue_file_key(file_name)
+        with self.__lock:
+            if file_name in self.__known:
+                return
+            self.__known.add(file_name)
+            if self.__head == len(self.__files) or key >= self.__keys[-1]:
+                self.__keys.append(key)
+                self.__files.append(file_name)
+            else:
+                i = bisect_right(self.__keys, key, self.__head)
+                self.__keys.insert(i, key)
+                self.__files.insert(i, file_name)
+
+    def files(self):
+        """@return list of queued files, oldest first"""
+        self.watcher.poll()
+        if self.inotify and not self.__watched or self.watcher.overflows != self.__overflows \
+                or self.rescan_interval is not None \
+                and not 0 <= time() - self.__scanned < self.rescan_interval:
+            self.rebuild()
+        with self.__lock:
+            return self.__files[self.__head:]
+
+    def remove(self, file_names):
+        """Removes processed files. Removing the oldest files is O(1) per file."""
+        if not file_names:
+            return
+        with self.__lock:
+            n = len(file_names)
+            if self.__files[self.__head:self.__head + n] == file_names:
+                self.__head += n
+            else:
+                drop = set(file_names)
+                keep = [i for i in range(self.__head, len(self.__files))
+                        if self.__files[i] not in drop]
+                self.__keys = [self.__keys[i] for i in keep]
+                self.__files = [self.__files[i] for i in keep]
+                self.__head = 0
+            self.__known.difference_update(file_names)
+            if self.__head > 1024 and self.__head * 2 > len(self.__files):
+                del self.__keys[:self.__head]
+                del self.__files[:self.__head]
+                self.__head = 0
+
+    def prune(self, file_names=None):
+        """Drops files that no longer exist, e.g. removed by a quota, an archive run or by hand.
+        @param file_names: files to check, default all queued files
+        @return number of dropped files
+        """
+        if file_names is None:
+            with self.__lock:
+                file_names = self.__files[self.__head:]
+        missing = [each_file for each_file in file_names if not os.path.exists(each_file)]
+        self.remove(missing)
+        return len(missing)
+
+    def __len__(self):
+        return len(self.__files) - self.__head
+
+    def close(self):
+        """Stops watching the directory. A shared watcher is closed by its owner."""
+        with _queue_events_lock:
+            _queue_indexes[self.path].remove(self)
+        if not self.__shared_watcher:
+            self.watcher.close()
+
+SEGMENT_NAME = 'segment-%08d.log'
+SPARE_NAME = 'segment-%08d.spare'
+CURSOR_NAME = 'cursor'
+NEXT_SEGMENT = -1  # frame length marking that the records continue in the next segment
+
+def preallocate(segment_file, size):
+    """Reserves the blocks of a segment file with posix_fallocate where available,
+    otherwise the file is only extended by truncate() and stays sparse, so a full
+    disk shows up on a later write instead of here.
+    """
+    segment_file.truncate(size)
+    fallocate = getattr(_libc, 'posix_fallocate64', None)
+    if fallocate is None:
+        return
+    err = fallocate(segment_file.fileno(), ctypes.c_int64(0), ctypes.c_int64(size))
+    if err:
+        logging.warning('posix_fallocate failed: ' + os.strerror(err))
+
+class SegmentStore(object):
+    """Queue of records in large preallocated segment files.
+    The writer appends records to the newest segment, the sender reads from a
+    persisted cursor and acknowledges what was sent. Segments behind the cursor
+    are zeroed and kept as spares for the writer instead of being deleted.
+    Within a segment the header of a record is written after its frame, so a
+    reader never sees a record that is only partly written. A full segment
+    ends with a NEXT_SEGMENT marker, which is on disk before the next segment
+    is created. Frames must not be empty, a zero length ends the records.
+    """
+
+    def __init__(self, path, segment_size=1048576):
+        """Opens the segment store of a queue directory.
+        @param path: queue directory
+        @param segment_size: size of a segment file in bytes
+        """
+        self.path = os.path.abspath(path)
+        self.segment_size = max(65536, segment_size)
+        self.__write_file = None
+        self.__read_file = None
+        self.__read_seq = None
+        self.cursor = self.__load_cursor()
+
+    def __name(self, seq):
+        return os.path.join(self.path, SEGMENT_NAME % seq)
+
+    def segments(self):
+        """@return sorted list of segment numbers"""
+        return sorted(int(os.path.basename(name)[8:16])
+                      for name in glob(os.path.join(self.path, 'segment-*.log')))
+
+    def __load_cursor(self):
+        """@return persisted (segment, offset) or start of the oldest segment"""
+        try:
+            with open(os.path.join(self.path, CURSOR_NAME)) as cursor_file:
+                seq, offset = cursor_file.read().split()
+                return int(seq), int(offset)
+        except (IOError, ValueError):
+            segments = self.segments()
+            return (segments[0] if segments else 0), 0
+
+    def __scan(self, data, offset):
+        """Walks the complete records in data starting at offset.
+        @return offset behind the last complete record and the length field found there
+        """
+        while offset + RECORD_HEADER.size <= len(data):
+            frame_length = RECORD_HEADER.unpack_from(data, offset)[1]
+            if frame_length <= 0 or offset + RECORD_HEADER.size + frame_length > len(data):
+                return offset, frame_length
+            offset += RECORD_HEADER.size + frame_length
+        return offset, 0
+
+    # writer side
+
+    def __open_head(self):
+        """Opens the newest segment and finds the end of its records."""
+        segments = self.segments()
+        if not segments:
+            self.__new_segment(self.cursor[0])
+            return
+        self.__write_seq = segments[-1]
+        self.__write_file = open(self.__name(self.__write_seq), 'r+b')
+        self.__write_pos, frame_length = self.__scan(self.__write_file.read(), 0)
+        if frame_length == NEXT_SEGMENT:  # stopped before the next segment was created
+            self.__new_segment(self.__write_seq + 1)
+
+    def __new_segment(self, seq):
+        """Starts segment seq from a spare segment or a new preallocated file."""
+        name = self.__name(seq)
+        for spare in glob(os.path.join(self.path, 'segment-*.spare')):
+            try:
+                os.rename(spare, name)
+                break
+            except OSError:  # taken by someone else
+                continue
+        else:
+            with open(name, 'ab') as segment_file:
+                preallocate(segment_file, self.segment_size)
+        if self.__write_file:
+            self.__write_file.close()
+        self.__write_file = open(name, 'r+b')
+        self.__write_seq = seq
+        self.__write_pos = 0
+
+    def append(self, data):
+        """Appends binary coded records (timestamp, length, frame).
+        @param data: one or more complete records
+        """
+        if not self.__write_file:
+            self.__open_head()
+        while data:
+            free = self.segment_size - self.__write_pos - RECORD_HEADER.size
+            end = len(data)
+            if end > free:
+                end = self.__scan(data[:free], 0)[0]
+            if end:
+                self.__write_at(self.__write_pos, data[:end])
+                self.__write_pos += end
+                data = data[end:]
+            if data:
+                # the marker is durable before the next segment exists, so a reader
+                # that finds the next segment never skips records of this one
+                self.__write_file.seek(self.__write_pos)
+                self.__write_file.write(RECORD_HEADER.pack(0, NEXT_SEGMENT))
+                self.__write_file.flush()
+                os.fsync(self.__write_file.fileno())
+                self.__new_segment(self.__write_seq + 1)
+
+    def __write_at(self, pos, data):
+        """Writes records at pos, the header of the first record last."""
+        self.__write_file.seek(pos + RECORD_HEADER.size)
+        self.__write_file.write(data[RECORD_HEADER.size:])
+        self.__write_file.flush()
+        self.__write_file.seek(pos)
+        self.__write_file.write(data[:RECORD_HEADER.size])
+        self.__write_file.flush()
+
+    def sync(self):
+        """Forces written records to disk."""
+        if self.__write_file:
+            self.__write_file.flush()
+            os.fsync(self.__write_file.fileno())
+
+    # reader side
+
+    def read(self, max_bytes=65536):
+        """Reads records behind the cursor.
+        @param max_bytes: number of bytes to read at most, at least one record is read
+        @return list of (timestamp, frame) tuples and the position to acknowledge
+        """
+        seq, offset = self.cursor
+        records = []
+        size = 0
+        rechecked = False
+        while size < max_bytes:
+            if self.__read_seq != seq:
+                if self.__read_file:
+                    self.__read_file.close()
+                    self.__read_file = None
+                try:
+                    self.__read_file = open(self.__name(seq), 'rb')
+                except IOError:
+                    break
+                self.__read_seq = seq
+            self.__read_file.seek(offset)
+            data = self.__read_file.read(max(max_bytes - size, 32768 + RECORD_HEADER.size))
+            end, frame_length = self.__scan(data, 0)
+            pos = 0
+            while pos < end:
+                timestamp, length = RECORD_HEADER.unpack_from(data, pos)
+                pos += RECORD_HEADER.size
+                records.append((timestamp, data[pos:pos + length]))
+                pos += length
+            offset += end
+            size += end
+            if frame_length == NEXT_SEGMENT:
+                seq, offset = seq + 1, 0
+                rechecked = False
+            elif end:
+                rechecked = False
+            elif os.path.exists(self.__name(seq + 1)):
+                # this segment is complete once the next exists: read it once more
+                # for records appended meanwhile, then skip a missing marker
+                if rechecked:
+                    logging.warning('Segment ' + str(seq) + ' ends without marker at ' +
+                                    str(offset) + ', continuing with the next segment.')
+                    seq, offset = seq + 1, 0
+                rechecked = not rechecked
+            else:
+                break
+        return records, (seq, offset)
+
+    def ack(self, position):
+        """Persists the cursor and recycles segments behind it.
+        @param position: position returned by read()
+        """
+        tmp_name = os.path.join(self.path, CURSOR_NAME + '.tmp')
+        with open(tmp_name, 'w') as cursor_file:
+            cursor_file.write('%d %d' % position)
+        os.rename(tmp_name, os.path.join(self.path, CURSOR_NAME))
+        self.cursor = position
+        for seq in self.segments():
+            if seq >= position[0]:
+                break
+            name = self.__name(seq)
+            with open(name, 'r+b') as segment_file:
+                segment_file.truncate(0)
+                preallocate(segment_file, self.segment_size)
+            os.rename(name, os.path.join(self.path, SPARE_NAME % seq))
+
+    def backlog(self):
+        """Measures the records between the persisted cursor and the write position.
+        Only the segments of the cursor and of the writer are scanned, the full
+        segments in between are counted with their size.
+        @return number of segments with unread records, their size in bytes and the
+        time stamp of the oldest unread record (None without unread records)
+        """
+        seq, offset = self.__load_cursor()
+        segments = [each for each in self.segments() if each >= seq]
+        count = size = 0
+        oldest = None
+        for i, each in enumerate(segments):
+            start = offset if each == seq else 0
+            try:
+                with open(self.__name(each), 'rb') as segment_file:
+                    segment_file.seek(start)
+                    if 0 < i < len(segments) - 1:
+                        data = segment_file.read(RECORD_HEADER.size)
+                        end = os.fstat(segment_file.fileno()).st_size - start
+                    else:
+                        data = segment_file.read()
+                        end = self.__scan(data, 0)[0]
+            except IOError:  # recycled meanwhile
+                continue
+            if end > 0 and len(data) >= RECORD_HEADER.size:
+                count += 1
+                size += end
+                if oldest is None:
+                    oldest = RECORD_HEADER.unpack_from(data, 0)[0]
+        return count, size, oldest
+
+    def pending(self):
+        """@return True if records are waiting behind the cursor"""
+        return bool(self.read(RECORD_HEADER.size)[0])
+
+    def close(self):
+        """Closes all segment files."""
+        for each_file in (self.__write_file, self.__read_file):
+            if each_file:
+                each_file.close()
+        self.__write_file = self.__read_file = None
+        self.__read_seq = None
+
+def frame_origin(frame):
+    """Returns the name of the (routed) Origin Frame a frame is wrapped in.
+    @param frame: binary coded frame as stored in queue files
+    @return origin name or '' for frames without origin
+    """
+    if len(frame) > 1 and ord(frame[0]) in (0xb, 0xd):
+        return str(frame[2:2 + ord(frame[1])])
+    return ''
+
+CLAIM_SUFFIX = '.quota'  # appended to a queue file while the quota evicts from it
+
+# 'oldest': delete the oldest files,
+# 'thin': keep only every thin_factor-th frame of the oldest files,
+# 'origin': remove frames of origins with the lowest priority first
+EVICTION_POLICIES = ('oldest', 'thin', 'origin')
+
+class QueueQuota(object):
+    """Keeps the queue files of a directory below a size budget.
+    Sizes of new files are added to a running total. The directory is only
+    scanned when the total exceeds the budget, then files are evicted until
+    the queue is below low_water * max_bytes. Sent .bak files are evicted
+    before unsent .rd files.
+    A file is claimed by renaming it before it is deleted or rewritten, so a
+    sender no longer picks it up. Rewritten records are published under a new
+    queue file name, so a file the sender already sent never reappears.
+    """
+
+    def __init__(self, path, max_bytes, policy='oldest', thin_factor=2,
+                 priorities=None, low_water=0.9):
+        """Creates a quota for a queue directory.
+        @param path: queue directory
+        @param max_bytes: budget in bytes
+        @param policy: one of EVICTION_POLICIES
+        @param thin_factor: every thin_factor-th frame is kept by the 'thin' policy
+        @param priorities: dictionary origin : priority for the 'origin' policy,
+        frames of unlisted origins have priority 0
+        @param low_water: fraction of max_bytes the queue is reduced to
+        """
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        if policy not in EVICTION_POLICIES:
+            logging.warning('Unknown eviction policy ' + str(policy) + '. Using oldest.')
+            policy = 'oldest'
+        self.policy = policy
+        self.thin_factor = max(2, thin_factor)
+        self.priorities = priorities or {}
+        self.low_water = low_water
+        self.evicted_frames = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.__lock = Lock()
+        self.__thinned = set()
+        for claimed in glob(os.path.join(self.path, '*' + CLAIM_SUFFIX)):  # left by a crash
+            os.rename(claimed, claimed[:-len(CLAIM_SUFFIX)])
+        self.size = self.scan()
+
+    def scan(self):
+        """@return size of all queue files in the directory"""
+        size = 0
+        for pattern in ('*.act', '*.rd', '*.bak'):
+            for each_file in glob(os.path.join(self.path, pattern)):
+                try:
+                    size += os.path.getsize(each_file)
+                except OSError:  # removed by the sender meanwhile
+                    pass
+        return size
+
+    def add(self, nbytes):
+        """Adds the size of a new file and evicts if the budget is exceeded.
+        @param nbytes: size of the new file
+        """
+        with self.__lock:
+            self.size += nbytes
+            if self.size > self.max_bytes:
+                self.size = self.scan()  # the sender may have removed files
+                if self.size > self.max_bytes:
+                    self.__evict()
+
+    def __evict(self):
+        """Evicts data until the queue is below the low water mark."""
+        target = self.low_water * self.max_bytes
+        before = self.size
+        candidates = [('bak', each_file) for each_file in
+                      sorted(glob(os.path.join(self.path, '*.bak')), key=queue_file_key)]
+        candidates += [('rd', each_file) for each_file in
+                       sorted(glob(os.path.join(self.path, '*.rd')), key=queue_file_key)]
+        if self.policy == 'thin':
+            for i, (kind, each_file) in enumerate(candidates):
+                if self.size <= target:
+                    break
+                if kind == 'bak':
+                    self.__delete(each_file)
+                elif each_file not in self.__thinned:
+                    new_file = self.__rewrite(each_file, lambda records: records[::self.thin_factor])
+                    self.__thinned.add(new_file)
+                    candidates[i] = (kind, new_file)
+        elif self.policy == 'origin':
+            levels = sorted(set(self.priorities.values()) | set([0]))
+            for level in levels[:-1]:  # the highest priority is only evicted as a whole file
+                for i, (kind, each_file) in enumerate(candidates):
+                    if self.size <= target:
+                        break
+                    if kind == 'bak':
+                        self.__delete(each_file)
+                    else:
+                        candidates[i] = (kind, self.__rewrite(each_file, lambda records: [
+                            (timestamp, frame) for timestamp, frame in records
+                            if self.priorities.get(frame_origin(frame), 0) > level]))
+        for kind, each_file in candidates:  # still too large: drop oldest files
+            if self.size <= target:
+                break
+            self.__delete(each_file)
+        logging.warning('Queue ' + self.path + ' exceeded ' + str(self.max_bytes) +
+                        ' bytes. Evicted ' + str(before - self.size) + ' bytes.')
+
+    def __claim(self, file_name):
+        """Renames a queue file, so senders and archive runs no longer take it.
+        @return claimed file name or None if the file was sent meanwhile
+        """
+        claimed = file_name + CLAIM_SUFFIX
+        try:
+            os.rename(file_name, claimed)
+        except OSError:
+            return None
+        return claimed
+
+    def __delete(self, file_name):
+        """Deletes a queue file and counts its frames."""
+        claimed = self.__claim(file_name)
+        if not claimed:
+            return
+        try:
+            with QueueFileReader(claimed) as reader:
+                frames = sum(1 for record in reader)
+                size = reader.size
+            os.remove(claimed)
+        except (IOError, OSError) as err:
+            logging.warning('Could not evict ' + file_name + ': ' + str(err))
+            return
+        self.__thinned.discard(file_name)
+        self.evicted_frames += frames
+        self.evicted_files += 1
+        self.evicted_bytes += size
+        self.size -= size
+
+    def __rewrite(self, file_name, select_records):
+        """Replaces a queue file by a selection of its records, published under a
+        new name with the same start time and sequence.
+        @param select_records: function returning the records to keep
+        @return name of the file now holding the records
+        """
+        try:
+            with QueueFileReader(file_name) as reader:
+                records = [(timestamp, str(frame)) for timestamp, frame in reader]
+                size = reader.size
+                crc = reader.crc
+        except (IOError, OSError):  # sent meanwhile
+            return file_name
+        kept = select_records(records)
+        if len(kept) == len(records):
+            return file_name
+        claimed = self.__claim(file_name)
+        if not claimed:
+            return file_name
+        data = ''.join(pack_record(timestamp, frame, crc) for timestamp, frame in kept)
+        if crc:
+            data = CRC_MAGIC + data
+        new_name = file_name
+        if kept:
+            prefix = os.path.basename(file_name).rpartition('-')
+            fd, tmp_name = tempfile.mkstemp('.tmp', prefix[0] + prefix[1], self.path)
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(data)
+            new_name = tmp_name[:-len('.tmp')] + '.rd'
+            os.rename(tmp_name, new_name)
+            notify_queue(self.path, new_name)
+        else:
+            self.evicted_files += 1
+        os.remove(claimed)
+        self.evicted_frames += len(records) - len(kept)
+        self.evicted_bytes += size - len(data)
+        self.size -= size - len(data)
+        return new_name
@@ -0,0 +1,139 @@
+"""Drift-free periodic scheduling of data acquisition.
+
+Ticks lie on a fixed grid aligned to wall-clock multiples of the period
+(plus a phase), but are timed with a monotonic clock, so neither the time
+spent reading nor changes of the system time shift them.
+"""
+
+import sys
+import ctypes
+import ctypes.util
+import logging
+from time import sleep, time
+from bayeosmetrics import Metrics
+
+# upper bounds of the tick latency histogram in seconds
+TICK_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+# sys.platform prefix : id of CLOCK_MONOTONIC in <time.h>
+CLOCK_IDS = {'linux' : 1,
+             'darwin' : 6,
+             'freebsd' : 4,
+             'openbsd' : 3,
+             'netbsd' : 3,
+             'sunos' : 4}
+
+CLOCK_MONOTONIC = None
+for _prefix, _clock_id in CLOCK_IDS.items():
+    if sys.platform.startswith(_prefix):
+        CLOCK_MONOTONIC = _clock_id
+
+try:
+    if CLOCK_MONOTONIC is None:
+        raise OSError('CLOCK_MONOTONIC unknown on ' + sys.platform)
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+                                 use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+except (OSError, AttributeError, TypeError):  # no clock_gettime on this platform
+    _clock_gettime = None
+
+_fallback_logged = False
+
+def _system_time():
+    """@return system time, logs once that no monotonic clock is used"""
+    global _fallback_logged
+    if not _fallback_logged:
+        _fallback_logged = True
+        logging.warning('No monotonic clock on ' + sys.platform +
+                        ', ticks are timed with the system time.')
+    return time()
+
+def monotonic():
+    """@return seconds of a clock that is not affected by changes of the system time,
+    system time if no monotonic clock is available
+    """
+    if _clock_gettime is None:
+        return _system_time()
+    spec = _Timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)):
+        return _system_time()
+    return spec.tv_sec + spec.tv_nsec * 1e-9
+
+class TickScheduler(object):
+    """Fires on absolute ticks first_tick + n * period.
+    If a cycle takes longer than a period, the missed ticks are skipped and
+    counted as overruns, later ticks stay on the grid.
+    """
+
+    def __init__(self, period, phase=0, name=None, immediate=False):
+        """Creates a scheduler.
+        @param period: seconds between two ticks, may be below one second
+        @param phase: offset in seconds of the ticks from wall-clock multiples of period,
+        e.g. to spread the ticks of many devices
+        @param name: if set, ticks, overruns, latency and cycle time are recorded in a
+        Metrics instance labeled with this name
+        @param immediate: if True the first tick fires at once, the following lie on the grid
+        """
+        if period <= 0:
+            raise ValueError('Period must be positive.')
+        self.period = float(period)
+        self.phase = phase % self.period
+        now = monotonic()
+        wall = time()
+        first_wall = (wall - self.phase) // self.period * self.period + self.phase + self.period
+        self.next_tick = now + first_wall - wall
+        self.__grid_tick = None
+        if immediate:
+            self.__grid_tick = self.next_tick
+            self.next_tick = now
+        self.ticks = 0
+        self.overruns = 0
+        self.metrics = None
+        self.__fired = None
+        if name is not None:
+            self.metrics = Metrics('scheduler', {'name' : name})
+            self.metrics.counter('ticks', lambda: self.ticks)
+            self.metrics.counter('overruns', lambda: self.overruns)
+
+    def wait(self):
+        """Sleeps until the next tick and fires it.
+        @return latency of the tick in seconds
+        """
+        delay = self.next_tick - monotonic()
+        if delay > 0:
+            sleep(delay)
+        return self.tick()
+
+    def tick(self):
+        """Fires the due tick and moves to the next one.
+        @return latency of the tick in seconds
+        """
+        now = monotonic()
+        latency = now - self.next_tick
+        self.ticks += 1
+        if self.__grid_tick is not None:  # first tick was fired at once
+            self.next_tick = self.__grid_tick
+            self.__grid_tick = None
+        else:
+            self.next_tick += self.period
+        if self.next_tick <= now:
+            missed = int((now - self.next_tick) // self.period) + 1
+            self.next_tick += missed * self.period
+            self.overruns += missed
+            logging.warning('Scheduler overrun: skipped ' + str(missed) + ' ticks.')
+        if self.metrics:
+            self.metrics.observe('tick_latency_seconds', max(0, latency), TICK_BUCKETS)
+        self.__fired = now
+        return latency
+
+    def done(self):
+        """Records the duration of the cycle started by the last tick.
+        @return duration in seconds
+        """
+        duration = monotonic() - self.__fired
+        if self.metrics:
+            self.metrics.observe('cycle_seconds', duration, TICK_BUCKETS)
+        return duration
@@ -0,0 +1,39 @@
+"""Runs many writer-sender pairs in one thread driven by a select loop."""
+
+import tempfile
+from os import path
+from select import select
+from time import time
+from random import random
+from bayeosgatewayclient import BayEOSExecutor, AsyncBayEOSWriter, AsyncBayEOSSender
+
+URL = 'http://bayconf.bayceer.uni-bayreuth.de/gateway/frame/saveFlat'
+DEVICES = 100
+WRITER_SLEEP = 1
+SENDER_SLEEP = 10
+
+def sent(count, error):
+    if count:
+        print 'Successfully sent ' + str(count) + ' frames.'
+
+executor = BayEOSExecutor(workers=4)
+devices = []
+for i in range(DEVICES):
+    name = 'Python-Async-Device' + str(i)
+    device_path = path.join(tempfile.gettempdir(), 'bayeos-async', name)
+    devices.append((AsyncBayEOSWriter(executor, device_path),
+                    AsyncBayEOSSender(executor, device_path, name, URL)))
+
+next_save = next_send = time()
+while True:
+    readable = select([executor], [], [], max(0, min(next_save, next_send) - time()))[0]
+    if readable:
+        executor.dispatch()
+    if time() >= next_save:
+        for writer, sender in devices:
+            writer.save([random(), random()])
+        next_save += WRITER_SLEEP
+    if time() >= next_send:
+        for writer, sender in devices:
+            sender.send(callback=sent)
+        next_send += SENDER_SLEEP
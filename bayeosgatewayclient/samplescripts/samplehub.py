@@ -0,0 +1,24 @@
+"""Runs many devices in two hub processes instead of one process per device."""
+
+from bayeosgatewayclient import BayEOSGatewayClient
+from random import randint
+
+OPTIONS = {'bayeosgateway_url' : 'http://bayconf.bayceer.uni-bayreuth.de/gateway/frame/saveFlat',
+           'bayeosgateway_password' : 'import',
+           'bayeosgateway_user' : 'import',
+           'writer_sleep_time' : 1,
+           'sender_sleep_time' : 10,
+           'sender' : 'hub',
+           'hub_processes' : 2,
+           'hub_workers' : 8}
+
+NAMES = ['PythonHubDevice' + str(i) for i in range(200)]
+
+class PythonHubDevice(BayEOSGatewayClient):
+    """Reads data for every NAME, self.name tells which device is read."""
+    def read_data(self):
+        return (randint(-1, 1), len(self.name))
+
+client = PythonHubDevice(NAMES, OPTIONS)
+
+client.run_hub()
@@ -0,0 +1,14 @@
+"""Prints the content of BayEOSWriter queue files."""
+
+import sys
+from glob import glob
+from bayeosgatewayclient import BayEOSFrame, QueueFileReader
+
+PATH = '/tmp/bayeos-device1/'
+
+for file_name in sys.argv[1:] or sorted(glob(PATH + '*.rd')):
+    with QueueFileReader(file_name) as reader:
+        for timestamp, frame in reader:
+            print timestamp, BayEOSFrame.parse_frame(str(frame), {'origin' : '', 'timestamp' : timestamp})
+        if reader.truncated:
+            print file_name, 'has a truncated record of', reader.truncated, 'bytes'
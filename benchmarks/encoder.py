@@ -0,0 +1,24 @@
+"""Compares DataFrame.create with the precompiled DataFrameEncoder."""
+
+from timeit import timeit
+from bayeosgatewayclient import BayEOSFrame, DataFrameEncoder
+
+NUMBER = 100000
+LAYOUTS = [('float32, indices', 0x41, [2.1, 3, 20.5, 4.2, 1.0, 7.7, 8.8, 9.9]),
+           ('int32, offset', 0x02, [1, 2, 3, 4, 5, 6, 7, 8]),
+           ('int16, no offset', 0x23, [1, 2, 3, 4, 5, 6, 7, 8]),
+           ('float32, labels', 0x61, {'c1' : 1.2, 'c2' : 1.7, 'temp' : 20.5})]
+
+def create(values, value_type):
+    data_frame = BayEOSFrame.factory(0x1)
+    data_frame.create(values, value_type)
+    return data_frame.frame
+
+for name, value_type, values in LAYOUTS:
+    channels, row = DataFrameEncoder.layout(values)
+    encoder = DataFrameEncoder(value_type, channels)
+    assert encoder.encode(row) == create(values, value_type)
+    t_create = timeit(lambda: create(values, value_type), number=NUMBER)
+    t_encode = timeit(lambda: encoder.encode(row), number=NUMBER)
+    print '%-18s create: %8.0f frames/s  encoder: %8.0f frames/s  speedup: %.1fx' % \
+        (name, NUMBER / t_create, NUMBER / t_encode, t_create / t_encode)
@@ -0,0 +1,29 @@
+"""Compares BayEOSFrame.parse_frame with the iterative decode_frame."""
+
+from timeit import timeit
+from bayeosgatewayclient import BayEOSFrame, decode_frame
+
+NUMBER = 20000
+
+def frame(frame_type, *args):
+    bayeos_frame = BayEOSFrame.factory(frame_type)
+    bayeos_frame.create(*args)
+    return bayeos_frame.frame
+
+# nested frames as in samplescripts/sampleframes.py
+DATA = frame(0x1, (2, 5, 4), 0x22)
+ROUTED = frame(0x6, 11, 3331, frame(0x8, 12, 3332, 64, DATA))
+FRAMES = [('data', DATA),
+          ('data, 16 float32', frame(0x1, range(16), 0x41)),
+          ('timestamp(data)', frame(0xc, DATA, 1400000000)),
+          ('timestamp(origin(data))', frame(0xc, frame(0xb, 'My Origin', DATA), 1400000000)),
+          ('checksum(routed(routed rssi(data)))', frame(0xf, ROUTED)),
+          ('routed rssi(routed origin(checksum(routed(..))))',
+           frame(0x8, 12, 3332, 64, frame(0xd, 'RoutedOrigin', frame(0xf, ROUTED))))]
+
+for name, binary in FRAMES:
+    t_parse = timeit(lambda: BayEOSFrame.parse_frame(binary, {'origin' : '', 'timestamp' : 0}),
+                     number=NUMBER)
+    t_decode = timeit(lambda: decode_frame(binary), number=NUMBER)
+    print '%-50s parse_frame: %7.0f frames/s  decode_frame: %7.0f frames/s  speedup: %.1fx' % \
+        (name, NUMBER / t_parse, NUMBER / t_decode, t_parse / t_decode)
@@ -0,0 +1,33 @@
+"""Compares bytes on wire per 1000 frames for uncompressed and compressed POSTs."""
+
+import base64
+from random import random
+from time import time
+from urllib import urlencode
+from bayeosgatewayclient import BayEOSFrame, CONTENT_ENCODINGS
+
+FRAMES = 1000
+CHANNELS = 8
+
+def frames(value):
+    """@return list of base64 encoded Timestamp Frames as posted by BayEOSSender"""
+    result = []
+    start = time()
+    for i in range(FRAMES):
+        data_frame = BayEOSFrame.factory(0x1)
+        data_frame.create([value(i, channel) for channel in range(CHANNELS)], 0x41)
+        wrapper_frame = BayEOSFrame.factory(0xc)
+        wrapper_frame.create(data_frame.frame, start + i)
+        result.append(base64.b64encode(wrapper_frame.frame))
+    return result
+
+SIGNALS = [('random values', lambda i, channel: random()),
+           ('slow signal', lambda i, channel: 20.0 + channel + (i // 60) * 0.1)]
+
+for name, value in SIGNALS:
+    body = urlencode({'sender' : 'Benchmark', 'bayeosframes[]' : frames(value)}, True)
+    print '%-14s plain: %7d bytes' % (name, len(body)),
+    for encoding in sorted(CONTENT_ENCODINGS):
+        size = len(CONTENT_ENCODINGS[encoding](body))
+        print ' %s: %7d bytes (%.0f%%)' % (encoding, size, 100.0 * size / len(body)),
+    print
@@ -0,0 +1,156 @@
+"""Benchmark suite for frame handling, BayEOSWriter and BayEOSSender.
+
+Runs offline: the sender posts to a stand-in gateway on localhost.
+Results are written as JSON, so they can be compared between versions:
+
+    python benchmarks/suite.py --output results.json
+"""
+
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+from time import time
+from datetime import datetime
+from bayeosgatewayclient import BayEOSFrame, BayEOSWriter, BayEOSSender, BayEOSGatewayEmulator, \
+    decode_frame
+
+TIMESTAMP = 1400000000.0
+
+def data_frame():
+    frame = BayEOSFrame.factory(0x1)
+    frame.create([2.1, 3, 20.5, 4.2], 0x41)
+    return frame.frame
+
+# frame type : positional arguments of create()
+FRAME_ARGS = {0x1 : ([2.1, 3, 20.5, 4.2], 0x41),
+              0x2 : (1, 'command'),
+              0x4 : ('This is a message.',),
+              0x5 : ('This is an error message.',),
+              0x6 : (11, 3331, data_frame()),
+              0x7 : (data_frame(), 1034),
+              0x8 : (12, 3332, 64, data_frame()),
+              0x9 : (data_frame(), TIMESTAMP),
+              0xa : ('This is binary data.',),
+              0xb : ('Origin', data_frame()),
+              0xc : (data_frame(), TIMESTAMP),
+              0xd : ('RoutedOrigin', data_frame()),
+              0xf : (data_frame(),)}
+
+def measure(func, number, repeat):
+    """@return best operations per second of repeat runs of number calls"""
+    best = None
+    for i in range(repeat):
+        start = time()
+        for j in xrange(number):
+            func()
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return number / best if best else float('inf')
+
+def bench_frames(number, repeat):
+    results = []
+    for frame_type, args in sorted(FRAME_ARGS.items()):
+        frame = BayEOSFrame.factory(frame_type)
+        frame.create(*args)
+        binary = frame.frame
+
+        def create():
+            BayEOSFrame.factory(frame_type).create(*args)
+
+        def parse():
+            BayEOSFrame.parse_frame(binary, {'origin' : '', 'timestamp' : TIMESTAMP})
+
+        for name, func in (('factory', lambda: BayEOSFrame.factory(frame_type)),
+                           ('create', create),
+                           ('parse_frame', parse),
+                           ('decode_frame', lambda: decode_frame(binary, TIMESTAMP))):
+            results.append({'group' : 'frame', 'name' : name, 'frame_type' : hex(frame_type),
+                            'ops_per_sec' : measure(func, number, repeat)})
+    return results
+
+def bench_writer(frames, chunks):
+    results = []
+    for max_chunk in chunks:
+        path = tempfile.mkdtemp(prefix='bayeos-bench-')
+        try:
+            writer = BayEOSWriter(path, max_chunk, log_level=logging.WARNING)
+            start = time()
+            for i in xrange(frames):
+                writer.save([i, 2.1, 3, 20.5])
+            writer.flush()
+            elapsed = time() - start
+            size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        finally:
+            shutil.rmtree(path)
+        results.append({'group' : 'writer', 'name' : 'save', 'max_chunk' : max_chunk,
+                        'frames_per_sec' : frames / elapsed, 'bytes_per_sec' : size / elapsed})
+    return results
+
+def bench_sender(files, frames_per_file, configurations):
+    gateway = BayEOSGatewayEmulator(validate=False)
+    gateway.start()
+    url = gateway.url
+    results = []
+    for name, options in configurations:
+        path = tempfile.mkdtemp(prefix='bayeos-bench-')
+        try:
+            writer = BayEOSWriter(path, log_level=logging.WARNING)
+            for i in xrange(files):
+                writer.save_many([([j, 2.1, 3, 20.5], TIMESTAMP + j) for j in range(frames_per_file)])
+                writer.flush()
+            sender = BayEOSSender(path, 'Benchmark', url, log_level=logging.WARNING, **options)
+            start = time()
+            count = sender.send()
+            elapsed = time() - start
+        finally:
+            shutil.rmtree(path)
+        results.append({'group' : 'sender', 'name' : name, 'files' : files,
+                        'frames' : count, 'frames_per_sec' : count / elapsed,
+                        'files_per_sec' : files / elapsed})
+    gateway.stop()
+    return results
+
+SENDER_CONFIGURATIONS = [('default', {}),
+                         ('batch', {'batch_frames' : 1000}),
+                         ('workers', {'workers' : 4, 'ordering' : 'none'}),
+                         ('gzip', {'compression' : 'gzip'})]
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the bayeosgatewayclient benchmarks.')
+    parser.add_argument('-o', '--output', help='JSON file for the results, default stdout')
+    parser.add_argument('-q', '--quick', action='store_true', help='fewer iterations')
+    args = parser.parse_args()
+    scale = 10 if args.quick else 1
+
+    results = []
+    results += bench_frames(20000 // scale, 3)
+    results += bench_writer(20000 // scale, (500, 2500, 10000, 100000))
+    results += bench_sender(200 // scale, 50, SENDER_CONFIGURATIONS)
+
+    for result in results:
+        rates = ', '.join('%s=%.0f' % (key, value) for key, value in sorted(result.items())
+                          if key.endswith('_per_sec'))
+        labels = ', '.join('%s=%s' % (key, value) for key, value in sorted(result.items())
+                           if not key.endswith('_per_sec') and key != 'group')
+        sys.stderr.write('%-7s %-50s %s\n' % (result['group'], labels, rates))
+
+    report = {'date' : datetime.utcnow().isoformat(),
+              'python' : platform.python_version(),
+              'platform' : platform.platform(),
+              'quick' : args.quick,
+              'results' : results}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=1, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        print
+
+if __name__ == '__main__':
+    main()
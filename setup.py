@@ -16,4 +16,5 @@ setup(
     license='GPL2',
     keywords='bayeos gateway client',
     classifiers=['Programming Language :: Python'],
-    install_requires=['requests'])
+    install_requires=['requests'],
+    extras_require={'numpy': ['numpy']})